@@ -11,6 +11,10 @@
 #define BUFFER_LEN 1024
 // Toggles FPS output (1 = print FPS over serial, 0 = disable output)
 #define PRINT_FPS 1
+// Packet format, must match ESP8266_PROTOCOL in config.py
+// 1 = |i|r|g|b| (up to 256 LEDs), 2 = |2|i_hi|i_lo|r|g|b| (up to 65536 LEDs)
+// 3 = protocol 2 plus raw and run-length encoded packets (see codec.py)
+#define PROTOCOL_VERSION 1
 
 // Wifi and socket settings
 const char* ssid     = "YOUR_WIFI_SSID";
@@ -49,7 +53,7 @@ void setup() {
     ledstrip.init(NUM_LEDS);
 }
 
-uint8_t N = 0;
+uint16_t N = 0;
 #if PRINT_FPS
     uint16_t fpsCounter = 0;
     uint32_t secondTimer = 0;
@@ -61,13 +65,56 @@ void loop() {
     // If packets have been received, interpret the command
     if (packetSize) {
         int len = port.read(packetBuffer, BUFFER_LEN);
-        for(int i = 0; i < len; i+=4) {
-            packetBuffer[len] = 0;
-            N = packetBuffer[i];
+        #if PROTOCOL_VERSION == 1
+        for(int i = 0; i + 3 < len; i+=4) {
+            N = (uint8_t)packetBuffer[i];
+            if (N >= NUM_LEDS) continue;
             pixels[N].R = (uint8_t)packetBuffer[i+1];
             pixels[N].G = (uint8_t)packetBuffer[i+2];
             pixels[N].B = (uint8_t)packetBuffer[i+3];
-        } 
+        }
+        #else
+        if (len < 1) return;
+        // The first byte of every packet selects its encoding
+        uint8_t type = (uint8_t)packetBuffer[0];
+        if (type == 2) {
+            // |2|i_hi|i_lo|r|g|b|...
+            for(int i = 1; i + 4 < len; i+=5) {
+                N = ((uint16_t)(uint8_t)packetBuffer[i] << 8) | (uint8_t)packetBuffer[i+1];
+                if (N >= NUM_LEDS) continue;
+                pixels[N].R = (uint8_t)packetBuffer[i+2];
+                pixels[N].G = (uint8_t)packetBuffer[i+3];
+                pixels[N].B = (uint8_t)packetBuffer[i+4];
+            }
+        }
+        #if PROTOCOL_VERSION >= 3
+        else if (type == 3 && len >= 3) {
+            // |3|start_hi|start_lo|r|g|b|r|g|b|...
+            N = ((uint16_t)(uint8_t)packetBuffer[1] << 8) | (uint8_t)packetBuffer[2];
+            for(int i = 3; i + 2 < len && N < NUM_LEDS; i+=3, N++) {
+                pixels[N].R = (uint8_t)packetBuffer[i];
+                pixels[N].G = (uint8_t)packetBuffer[i+1];
+                pixels[N].B = (uint8_t)packetBuffer[i+2];
+            }
+        }
+        else if (type == 4) {
+            // |4|start_hi|start_lo|n|r|g|b|...
+            for(int i = 1; i + 5 < len; i+=6) {
+                N = ((uint16_t)(uint8_t)packetBuffer[i] << 8) | (uint8_t)packetBuffer[i+1];
+                uint8_t count = (uint8_t)packetBuffer[i+2];
+                for(uint8_t j = 0; j < count && N < NUM_LEDS; j++, N++) {
+                    pixels[N].R = (uint8_t)packetBuffer[i+3];
+                    pixels[N].G = (uint8_t)packetBuffer[i+4];
+                    pixels[N].B = (uint8_t)packetBuffer[i+5];
+                }
+            }
+        }
+        #endif
+        else {
+            // Ignore packets sent with a different protocol version
+            return;
+        }
+        #endif
         ledstrip.show(pixels);
         #if PRINT_FPS
             fpsCounter++;
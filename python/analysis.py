@@ -0,0 +1,199 @@
+"""Audio analysis shared by the live visualization and the offline renderer"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+from scipy.ndimage.filters import gaussian_filter1d
+import config
+import dsp
+
+filters = dsp.FilterBank()
+"""State of the analysis filters"""
+
+mel_gain = dsp.ExpFilter(np.tile(1e-1, config.N_FFT_BINS),
+                         alpha_decay=0.01, alpha_rise=0.99, bank=filters)
+mel_smoothing = dsp.ExpFilter(np.tile(1e-1, config.N_FFT_BINS),
+                         alpha_decay=0.5, alpha_rise=0.99, bank=filters)
+stereo_mel_smoothing = dsp.ExpFilter(np.tile(1e-1, (2, config.N_FFT_BINS)),
+                         alpha_decay=0.5, alpha_rise=0.99, bank=filters)
+
+
+def scale_mel(mel):
+    """Scales mel filterbank output to values more suitable for visualization
+
+    The mel energies are squared, normalized by a slowly decaying estimate
+    of their peak value and smoothed over time. Stereo mel energies are
+    (2, N_FFT_BINS) rows that share the gain, which keeps their balance.
+    """
+    mel = mel**2.0
+    # Gain normalization
+    mel_gain.update(np.max(gaussian_filter1d(mel, sigma=1.0, axis=-1)))
+    mel /= mel_gain.value
+    if mel.ndim == 1:
+        return mel_smoothing.update(mel)
+    return stereo_mel_smoothing.update(mel)
+
+
+class Features:
+    """Audio features of one frame, computed once and read by every effect
+    and output device
+
+    Attributes
+    ----------
+    mel : np.array
+        Scaled mel energies, see scale_mel().
+    delta : np.array
+        Change of the scaled mel energies since the previous frame.
+    bands : np.array
+        Low, mid and high energies: the mean of every third of the mel
+        energies, each normalized by its own slowly decaying peak value.
+    peaks : np.array
+        Largest normalized mel energy of every third.
+    rms : float
+        RMS of the audio samples in the rolling window.
+    volume : float
+        Slowly smoothed rms.
+    flux : float
+        Spectral flux, the sum of the increases of the mel energies.
+    onset : bool
+        Whether the spectral flux jumped above its recent mean.
+    beat : bool
+        Whether the flux of the low third jumped above its recent mean,
+        which follows the kick drum and bass.
+
+    Stereo features have a row of mel, delta, bands and peaks per channel,
+    and channel() returns the features of a single channel. The other values
+    are measured over both channels.
+    """
+    def __init__(self, n_channels=None, n_bins=None, arrays=None):
+        shape = () if n_channels is None else (n_channels,)
+        n_bins = config.N_FFT_BINS if n_bins is None else n_bins
+        if arrays is None:
+            # mel and delta next to each other, so effects gather both at once
+            arrays = (np.zeros(shape + (2, n_bins)), np.zeros(shape + (3,)),
+                      np.zeros(shape + (3,)))
+        self.spectra, self.bands, self.peaks = arrays
+        self.mel = self.spectra[..., 0, :]
+        self.delta = self.spectra[..., 1, :]
+        self.rms = 0.0
+        self.volume = 0.0
+        self.flux = 0.0
+        self.onset = False
+        self.beat = False
+        # Views of the rows of stereo features
+        self._channels = [Features(arrays=rows) for rows in zip(*arrays)] \
+            if self.bands.ndim > 1 else []
+
+    @property
+    def low(self):
+        return self.bands[..., 0]
+
+    @property
+    def mid(self):
+        return self.bands[..., 1]
+
+    @property
+    def high(self):
+        return self.bands[..., 2]
+
+    def channel(self, i):
+        """Returns the features of one channel of stereo features"""
+        return self._copy_values(self._channels[i])
+
+    def copy(self):
+        """Returns a copy that is not overwritten by later frames"""
+        features = Features(arrays=(self.spectra.copy(), self.bands.copy(), self.peaks.copy()))
+        return self._copy_values(features)
+
+    def _copy_values(self, features):
+        features.rms, features.volume, features.flux = self.rms, self.volume, self.flux
+        features.onset, features.beat = self.onset, self.beat
+        return features
+
+
+class OnsetDetector:
+    """Streaming onset detector for a novelty signal such as spectral flux
+
+    A frame is an onset when the signal rises above threshold times its
+    recent mean, and at least min_interval seconds after the previous onset.
+    """
+    def __init__(self, threshold=1.5, min_interval=0.1, alpha=0.1, minimum=1e-3):
+        self.threshold = threshold
+        self.minimum = minimum
+        self.min_frames = max(1, int(round(min_interval * config.FPS)))
+        self.mean = dsp.ExpFilter(0.0, alpha_decay=alpha, alpha_rise=alpha)
+        self._frames = self.min_frames
+
+    def update(self, value):
+        """Returns whether the new value of the signal is an onset"""
+        limit = self.threshold * self.mean.value
+        self.mean.update(value)
+        self._frames += 1
+        if value > limit and value > self.minimum and self._frames >= self.min_frames:
+            self._frames = 0
+            return True
+        return False
+
+
+class FeatureExtractor:
+    """Computes the Features of every frame from the scaled mel energies
+
+    The state of the features, such as the previous mel energies, the gain
+    of every mel band and the onset detectors, is kept between frames.
+    Everything is computed in place in preallocated buffers.
+    """
+    def __init__(self, n_channels=None, n_bins=None):
+        shape = () if n_channels is None else (n_channels,)
+        n_bins = config.N_FFT_BINS if n_bins is None else n_bins
+        self._previous = np.zeros(shape + (n_bins,))
+        self._rising = np.zeros(shape + (n_bins,))
+        self._normalized = np.zeros(shape + (n_bins,))
+        self._band_flux = np.zeros(shape + (3,))
+        self._loudest = np.zeros(n_bins)
+        # Same thirds as the effects used to split the mel energies into
+        self._edges = [0, n_bins // 3, 2 * n_bins // 3]
+        self._counts = np.diff(self._edges + [n_bins]).astype(float)
+        self.gain = dsp.ExpFilter(np.tile(0.01, n_bins), alpha_decay=0.001, alpha_rise=0.99)
+        self.volume = dsp.ExpFilter(config.MIN_VOLUME_THRESHOLD,
+                                    alpha_decay=0.02, alpha_rise=0.02)
+        self.onsets = OnsetDetector(threshold=1.5, min_interval=0.1)
+        self.beats = OnsetDetector(threshold=1.8, min_interval=0.3)
+
+    def extract(self, mel, samples=None, out=None):
+        """Returns the features of a frame
+
+        Parameters
+        ----------
+        mel : np.array
+            Scaled mel energies of the frame, (2, n_bins) in stereo.
+        samples : np.array, optional
+            Audio samples of the rolling window, (2, n) in stereo, used for
+            the RMS.
+        out : Features, optional
+            Features that are overwritten with the new frame.
+        """
+        if out is None:
+            out = Features(None if np.ndim(mel) == 1 else len(mel), np.shape(mel)[-1])
+        out.mel[...] = mel
+        np.subtract(out.mel, self._previous, out=out.delta)
+        self._previous[...] = out.mel
+        # Spectral flux per band, counting only increases
+        np.maximum(out.delta, 0.0, out=self._rising)
+        np.add.reduceat(self._rising, self._edges, axis=-1, out=self._band_flux)
+        out.flux = float(self._band_flux.sum())
+        out.onset = self.onsets.update(out.flux)
+        out.beat = self.beats.update(float(self._band_flux[..., 0].sum()))
+        # Every mel band relative to its recent peak, with one gain for both
+        # stereo channels, so a quiet channel stays dimmer
+        if out.mel.ndim > 1:
+            np.max(out.mel, axis=0, out=self._loudest)
+            self.gain.update(self._loudest)
+        else:
+            self.gain.update(out.mel)
+        normalized = np.divide(out.mel, self.gain.value, out=self._normalized)
+        np.add.reduceat(normalized, self._edges, axis=-1, out=out.bands)
+        out.bands /= self._counts
+        np.maximum.reduceat(normalized, self._edges, axis=-1, out=out.peaks)
+        if samples is not None:
+            out.rms = float(np.sqrt(np.vdot(samples, samples) / samples.size))
+        out.volume = self.volume.update(out.rms)
+        return out
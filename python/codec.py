@@ -0,0 +1,163 @@
+"""Adaptive frame codec for the ESP8266 UDP protocol
+
+Every frame is encoded in whichever packet format costs the fewest bytes,
+because WiFi airtime is the bottleneck when several LED strips share one
+access point. Frames identical to the previously sent frame are skipped.
+
+All multi-byte values are big-endian. Protocol 1 packets contain only
+|i|r|g|b| records. In protocols 2 and 3 every packet starts with a type byte:
+
+    2 (delta): |2|i_hi|i_lo|r|g|b|...
+        Sets the listed pixels. Sent by protocols 2 and 3.
+    3 (raw): |3|start_hi|start_lo|r|g|b|r|g|b|...
+        Sets consecutive pixels beginning at start. Protocol 3 only.
+    4 (run-length): |4|start_hi|start_lo|n|r|g|b|...
+        Sets n (1 to 255) pixels beginning at start to one color.
+        Protocol 3 only.
+"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+
+DELTA = 2
+RAW = 3
+RLE = 4
+
+_BUFFER_LEN = 1024
+"""Largest packet the firmware accepts, must match BUFFER_LEN in ws2812_controller.ino"""
+
+_MAX_RUN = 255
+"""Longest run of pixels that a single run-length record can describe"""
+
+
+def _n_packets(n_records, per_packet):
+    return -(-n_records // per_packet)
+
+
+def _packetize(header, records, per_packet):
+    """Splits a 2D uint8 array of records into packets with a common header"""
+    data = records.tobytes()
+    packet_len = per_packet * records.shape[1]
+    return [header + data[i:i + packet_len]
+            for i in range(0, len(data), packet_len)]
+
+
+def _split_index(records, idx, lo):
+    """Writes 16-bit indices into two record columns starting at lo"""
+    records[:, lo] = idx >> 8
+    records[:, lo + 1] = idx & 0xFF
+
+
+class FrameCodec:
+    """Encodes pixel frames for one ESP8266, tracking what it last received"""
+    def __init__(self, protocol=1):
+        assert protocol in (1, 2, 3), 'Invalid ESP8266 protocol'
+        self.protocol = protocol
+        self.prev = None
+        self.frames = 0
+        self.skipped = 0
+        self.last_bytes = 0
+        self.total_bytes = 0
+
+    def reset(self):
+        """Forgets the last sent frame so that the next one is sent in full"""
+        self.prev = None
+
+    def bytes_per_frame(self):
+        """Returns the mean number of bytes sent per encoded frame"""
+        return self.total_bytes / max(self.frames, 1)
+
+    def encode(self, p):
+        """Returns the packets that turn the previous frame into p
+
+        Parameters
+        ----------
+        p : ndarray
+            (3, N) array of gamma corrected uint8 compatible pixel values.
+        """
+        p = np.array(p, dtype=np.uint8)
+        if self.prev is None:
+            changed = np.arange(p.shape[1])
+        else:
+            changed = np.flatnonzero(np.any(p != self.prev, axis=0))
+        self.frames += 1
+        if len(changed) == 0:
+            self.skipped += 1
+            self.last_bytes = 0
+            return []
+        if self.protocol == 1:
+            packets = self._encode_delta_v1(p, changed)
+        elif self.protocol == 2:
+            packets = self._encode_delta(p, changed)
+        else:
+            packets = self._encode_smallest(p, changed)
+        self.prev = p
+        self.last_bytes = sum(len(m) for m in packets)
+        self.total_bytes += self.last_bytes
+        return packets
+
+    def _encode_smallest(self, p, changed):
+        n_pixels = p.shape[1]
+        starts, lengths = self._runs(p)
+        per_delta = (_BUFFER_LEN - 1) // 5
+        per_raw = (_BUFFER_LEN - 3) // 3
+        per_rle = (_BUFFER_LEN - 1) // 6
+        cost = {
+            DELTA: 5 * len(changed) + _n_packets(len(changed), per_delta),
+            RAW: 3 * n_pixels + 3 * _n_packets(n_pixels, per_raw),
+            RLE: 6 * len(starts) + _n_packets(len(starts), per_rle),
+        }
+        best = min(cost, key=cost.get)
+        if best == DELTA:
+            return self._encode_delta(p, changed)
+        if best == RAW:
+            return self._encode_raw(p, per_raw)
+        return self._encode_rle(p, starts, lengths, per_rle)
+
+    @staticmethod
+    def _runs(p):
+        """Returns start and length of the runs of identical pixels in p"""
+        n_pixels = p.shape[1]
+        edges = np.flatnonzero(np.any(p[:, 1:] != p[:, :-1], axis=0)) + 1
+        starts = np.concatenate(([0], edges))
+        lengths = np.diff(np.append(starts, n_pixels))
+        # Split runs that are too long for a single record
+        n_split = _n_packets(lengths, _MAX_RUN)
+        if np.any(n_split > 1):
+            first = np.repeat(starts, n_split)
+            part = np.arange(len(first)) - np.repeat(np.cumsum(n_split) - n_split, n_split)
+            starts = first + part * _MAX_RUN
+            lengths = np.minimum(np.repeat(lengths, n_split) - part * _MAX_RUN,
+                                 _MAX_RUN)
+        return starts, lengths
+
+    @staticmethod
+    def _encode_delta_v1(p, changed):
+        records = np.empty((len(changed), 4), dtype=np.uint8)
+        records[:, 0] = changed
+        records[:, 1:] = p[:, changed].T
+        return _packetize(b'', records, 126)
+
+    @staticmethod
+    def _encode_delta(p, changed):
+        records = np.empty((len(changed), 5), dtype=np.uint8)
+        _split_index(records, changed, 0)
+        records[:, 2:] = p[:, changed].T
+        return _packetize(bytes(bytearray([DELTA])), records, (_BUFFER_LEN - 1) // 5)
+
+    @staticmethod
+    def _encode_raw(p, per_packet):
+        rgb = np.ascontiguousarray(p.T).tobytes()
+        packets = []
+        for start in range(0, p.shape[1], per_packet):
+            header = bytes(bytearray([RAW, start >> 8, start & 0xFF]))
+            packets.append(header + rgb[3 * start:3 * (start + per_packet)])
+        return packets
+
+    @staticmethod
+    def _encode_rle(p, starts, lengths, per_packet):
+        records = np.empty((len(starts), 6), dtype=np.uint8)
+        _split_index(records, starts, 0)
+        records[:, 2] = lengths
+        records[:, 3:] = p[:, starts].T
+        return _packetize(bytes(bytearray([RLE])), records, per_packet)
@@ -19,11 +19,39 @@ to control the leds connected to it.
 if DEVICE == 'esp8266':
     UDP_IP = '10.0.13.82'
     UDP_IP2 = '10.0.13.81'
-    """IP address of the ESP8266. Must match IP in ws2812_controller.ino"""
+    """IP address of the ESP8266. Must match IP in ws2812_controller.ino
+
+    These are only used for the default UDP_RECEIVERS list at the end of
+    this file. Edit UDP_RECEIVERS directly to drive more LED strips.
+    """
     UDP_PORT = 7777
     """Port number used for socket communication between Python and ESP8266"""
+    ESP8266_PROTOCOL = 1
+    """Packet format sent to the ESP8266. Must match PROTOCOL_VERSION in ws2812_controller.ino
+
+    1 sends |i|r|g|b| records and supports a maximum of 256 LEDs.
+    2 adds a version byte and uses 16-bit LED indices for longer LED strips.
+    3 picks the smallest of changed pixels, raw frame and run-length encoding
+    for every frame, which saves WiFi airtime. See codec.py for the formats.
+    """
+    UDP_KEYFRAME_INTERVAL = 1.0
+    """Seconds between complete frames sent to each ESP8266 (0 to disable)
+
+    Only changed pixels are sent most of the time, so a complete frame is sent
+    now and then to repair pixels that were lost with a dropped UDP packet.
+    """
     SOFTWARE_GAMMA_CORRECTION = True
     """Set to False because the firmware handles gamma correction + dither"""
+    TEMPORAL_DITHERING = False
+    """Whether to dither the 8-bit output values over time
+
+    Gamma correction maps dim colors onto only a few 8-bit output levels, so
+    slow fades at low brightness visibly step from one level to the next.
+    Temporal (sigma-delta) dithering alternates between the two nearest
+    levels from frame to frame, so their average shows the exact corrected
+    value. Disabled for the ESP8266, whose firmware dithers on its own, and
+    enabled for the Raspberry Pi and Blinkstick, which drive the LEDs directly.
+    """
 
 if DEVICE == 'pi':
     LED_PIN = 18
@@ -38,23 +66,65 @@ if DEVICE == 'pi':
     """Set True if using an inverting logic level converter"""
     SOFTWARE_GAMMA_CORRECTION = True
     """Set to True because Raspberry Pi doesn't use hardware dithering"""
+    TEMPORAL_DITHERING = True
 
 if DEVICE == 'blinkstick':
     SOFTWARE_GAMMA_CORRECTION = True
     """Set to True because blinkstick doesn't use hardware dithering"""
+    TEMPORAL_DITHERING = True
 
 USE_GUI = True
 """Whether or not to display a PyQtGraph GUI plot of visualization"""
 
+GUI_FPS = 30
+"""Refresh rate of the GUI window, which runs in a separate process"""
+
 DISPLAY_FPS = False
 """Whether to display the FPS when running (can reduce performance)"""
 
+METRICS_PORT = None
+"""Local port of the metrics endpoint, or None to disable metrics
+
+When set, the duration of every processing stage, every output device and
+the end-to-end latency from audio capture to output are recorded and served
+in the Prometheus text format on http://127.0.0.1:<METRICS_PORT>/metrics
+"""
+
+RECORD_PATH = None
+"""File to record the displayed LED frames to, or None to disable recording
+
+Recordings can be replayed without any audio processing using
+python recording.py <file>
+"""
+
 N_PIXELS = 60
 """Number of pixels in the LED strip (must match ESP8266 firmware)"""
 
 GAMMA_TABLE_PATH = os.path.join(os.path.dirname(__file__), 'gamma_table.npy')
 """Location of the gamma correction table"""
 
+MEL_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'mel_cache.npz')
+"""Location of the cached mel filterbanks, or None to only cache them in memory
+
+Filterbanks are kept for the most recently used sample rates, FFT lengths
+and frequency ranges, so they do not have to be computed again at startup.
+"""
+
+OUTPUT_BRIGHTNESS = {}
+"""Maximum brightness of the output devices between 0.0 and 1.0, by name
+
+For example {'pi': 0.5, 'lifx': 0.8}. Devices that are not listed are shown
+at full brightness.
+"""
+
+WHITE_BALANCE = {}
+"""Red, green and blue gains of the output devices between 0.0 and 1.0, by name
+
+Corrects the color temperature of a device whose white looks too cold or too
+warm, for example {'esp8266': (1.0, 0.85, 0.7)}. Devices that are not listed
+are not corrected.
+"""
+
 MIC_RATE = 48000
 """Sampling frequency of the microphone in Hz"""
 
@@ -74,8 +144,6 @@ appear "sluggish" or out of sync with the audio being played if it is too low.
 The FPS should not exceed the maximum refresh rate of the LED strip, which
 depends on how long the LED strip is.
 """
-_max_led_FPS = int(((N_PIXELS * 30e-6) + 50e-6)**-1.0)
-assert FPS <= _max_led_FPS, 'FPS must be <= {}'.format(_max_led_FPS)
 
 MIN_FREQUENCY = 120
 """Frequencies below this value will be removed during audio processing"""
@@ -83,6 +151,15 @@ MIN_FREQUENCY = 120
 MAX_FREQUENCY = 24000
 """Frequencies above this value will be removed during audio processing"""
 
+DECIMATION = True
+"""Whether to downsample the audio when MAX_FREQUENCY is well below MIC_RATE / 2
+
+The audio is low-pass filtered and downsampled before the FFT, so fewer
+samples are transformed every frame. This saves a lot of processing time on
+slow computers such as the Raspberry Pi when MAX_FREQUENCY is set to a few
+kHz. The frequency bands are the same with and without decimation.
+"""
+
 N_FFT_BINS = 30
 """Number of frequency bins to use when transforming audio to frequency domain
 
@@ -104,11 +181,106 @@ N_ROLLING_HISTORY = 2
 MIN_VOLUME_THRESHOLD = 1e-7
 """No music visualization displayed if recorded audio volume below threshold"""
 
+PIPELINE_QUEUE_SIZE = 4
+"""Maximum number of frames buffered between two pipeline stages"""
+
+PIPELINE_BACKPRESSURE = 'drop_oldest'
+"""What to do when a pipeline stage falls behind. Must be 'drop_oldest' or 'keep_latest'
+
+'drop_oldest' discards the oldest queued frame when a queue is full, so short
+hiccups are absorbed by the queue without delaying capture.
+
+'keep_latest' discards every queued frame whenever a new one arrives, so a
+slow stage always works on the most recent audio at the cost of skipping frames.
+"""
+
 AUDIO_SOURCE = 'loopback' # mic or loopback
+AUDIO_DEVICE = None # Index of the PyAudio input device to capture from, overrides AUDIO_SOURCE
+AUDIO_CHANNELS = 'mono'
+"""Channels of the audio input that are visualized. Must be 'mono', 'left', 'right' or 'stereo'
+
+'mono' averages every channel of the input device, 'left' and 'right' use
+only one channel. 'stereo' analyses the left and right channel together and
+draws the left half of the LED strip from the left channel and the right
+half from the right channel.
+"""
 
 CHROMA_TKL_KEYBOARD = True # TenKeyless, and for laptops
 CHROMA_VISTYPE_SCALED = False # Enabling will use another function which scales Chroma efffects. Try both I guess
+CHROMA_FPS = 30 # Chroma devices misbehave when they are updated too often
+LIFX_FPS = 15 # Maximum number of color changes sent to the LIFX bulbs per second
+LIFX_BULBS = [{'name': 'TV light'}, {'name': 'Window light'}]
+"""LIFX bulbs that follow the LED strip
+
+Every bulb is a dictionary with the 'name' of the bulb in the LIFX app and
+an optional 'pixels' (start, stop) range of the LED strip, whose mean color
+the bulb shows (default: the center pixel). For example, to light the left
+and right side of a room with the two halves of the strip:
+    [{'name': 'TV light', 'pixels': (0, 30)},
+     {'name': 'Window light', 'pixels': (30, 60)}]
+"""
+LIFX_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'lifx_cache.json')
+"""Location of the cached LIFX bulb addresses, so startup does not wait for discovery"""
 DEVICES_ENABLED = { "LED_STRIP2": False,
                     "CHROMA": True,
                     "LIFX": True
 }
+"""Additional output devices, each imported and initialized only when enabled
+
+Chroma and LIFX are only used together with the 'esp8266' DEVICE. The devices
+start in parallel, and one that fails to start is disabled for the rest of
+the run.
+"""
+
+if DEVICE == 'esp8266':
+    UDP_RECEIVERS = [{'ip': UDP_IP}]
+    if DEVICES_ENABLED["LED_STRIP2"]:
+        UDP_RECEIVERS.append({'ip': UDP_IP2})
+    """ESP8266 receivers that display the LED strip
+
+    Every receiver is a dictionary with an 'ip' and these optional keys:
+        'port': UDP port (default UDP_PORT)
+        'pixels': (start, stop) range or list of the pixels it displays,
+                  in order (default every pixel)
+        'protocol': packet format of its firmware (default ESP8266_PROTOCOL)
+        'keyframe_interval': overrides UDP_KEYFRAME_INTERVAL
+        'sndbuf', 'tos': SO_SNDBUF and IP_TOS socket options
+
+    For example, two strips showing one half of the visualization each:
+        [{'ip': '10.0.13.82', 'pixels': (0, 30)},
+         {'ip': '10.0.13.81', 'pixels': (30, 60)}]
+    """
+
+ZONES = []
+"""Independent visualizations run side by side by zones.py
+
+Every zone runs its own audio input, analysis, effect and LED outputs in a
+separate worker process. A zone is a dictionary with a 'name' and these
+optional keys:
+    'effect': 'scroll', 'energy' or 'spectrum' (default 'spectrum')
+    'cpu': CPU core, or list of cores, to pin the worker process to
+    'config': settings of this file to override in the worker, such as
+              AUDIO_DEVICE, N_PIXELS, UDP_RECEIVERS or METRICS_PORT. DEVICE,
+              UDP_IP, UDP_IP2 and DEVICES_ENABLED['LED_STRIP2'] cannot be
+              overridden, because the settings of the device and
+              UDP_RECEIVERS are derived from them.
+
+For example, two rooms with their own sound card and LED strip:
+    [{'name': 'kitchen', 'cpu': 1,
+      'config': {'AUDIO_DEVICE': 2, 'UDP_RECEIVERS': [{'ip': '10.0.13.82'}]}},
+     {'name': 'living room', 'cpu': 2, 'effect': 'energy',
+      'config': {'AUDIO_DEVICE': 3, 'UDP_RECEIVERS': [{'ip': '10.0.13.81'}]}}]
+"""
+
+
+def check():
+    """Asserts that the settings are valid, also after they were changed"""
+    if DEVICE == 'esp8266':
+        assert ESP8266_PROTOCOL in (1, 2, 3), 'ESP8266_PROTOCOL must be 1, 2 or 3'
+    max_led_fps = int(((N_PIXELS * 30e-6) + 50e-6)**-1.0)
+    assert FPS <= max_led_fps, 'FPS must be <= {}'.format(max_led_fps)
+    assert AUDIO_CHANNELS in ('mono', 'left', 'right', 'stereo'), \
+        "AUDIO_CHANNELS must be 'mono', 'left', 'right' or 'stereo'"
+
+
+check()
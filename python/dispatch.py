@@ -0,0 +1,103 @@
+"""Asynchronous per-sink output dispatcher
+
+Every output device (sink) gets its own worker thread and an optional target
+refresh rate. Frames are coalesced: a worker always sends the most recent
+frame and silently skips the ones it did not get to, so a slow or
+unresponsive sink never delays the others.
+"""
+from __future__ import print_function
+from __future__ import division
+import threading
+import time
+import metrics
+
+class SinkWorker(threading.Thread):
+    """Thread that sends the latest submitted frame to a single sink"""
+    def __init__(self, name, function, rate=None):
+        """Sends frames to function(frame) at most rate times per second
+
+        A rate of None sends every frame as soon as it is submitted.
+        """
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.function = function
+        self.interval = 1.0 / rate if rate else 0.0
+        self.sent = 0
+        self.coalesced = 0
+        self.errors = 0
+        self._frame = None
+        self._timestamp = None
+        self._cond = threading.Condition()
+        self._running = False
+
+    def submit(self, frame, timestamp=None):
+        """Replaces the pending frame with a newer one
+
+        The optional timestamp is the metrics.clock() time at which the
+        audio for this frame was captured, used to measure the latency.
+        """
+        with self._cond:
+            if self._frame is not None:
+                self.coalesced += 1
+            self._frame = frame
+            self._timestamp = timestamp
+            self._cond.notify()
+
+    def run(self):
+        self._running = True
+        next_send = metrics.monotonic()
+        while self._running:
+            with self._cond:
+                if self._frame is None:
+                    self._cond.wait(0.1)
+                if self._frame is None:
+                    continue
+            # Wait for the next slot, picking up any newer frames meanwhile
+            delay = next_send - metrics.monotonic()
+            if delay > 0.0:
+                time.sleep(delay)
+            with self._cond:
+                frame, self._frame = self._frame, None
+                timestamp = self._timestamp
+            try:
+                start = metrics.clock()
+                self.function(frame)
+                end = metrics.clock()
+                self.sent += 1
+                metrics.observe('led_sink_seconds', end - start, sink=self.name)
+                if timestamp is not None:
+                    metrics.observe('led_latency_seconds', end - timestamp, sink=self.name)
+            except Exception as e:
+                self.errors += 1
+                if self.errors == 1:
+                    print('Output to {} failed: {}'.format(self.name, e))
+            next_send = max(next_send + self.interval, metrics.monotonic())
+
+    def stop(self):
+        self._running = False
+
+
+class Dispatcher:
+    """Fans frames out to any number of independently paced sinks"""
+    def __init__(self):
+        self.workers = []
+
+    def add_sink(self, name, function, rate=None):
+        worker = SinkWorker(name, function, rate)
+        self.workers.append(worker)
+        return worker
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+
+    def submit(self, frame, timestamp=None):
+        """Hands a frame to every sink without waiting for any of them"""
+        for worker in self.workers:
+            worker.submit(frame, timestamp)
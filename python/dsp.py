@@ -1,28 +1,388 @@
 from __future__ import print_function
+import collections
+import os
+import tempfile
+import threading
 import numpy as np
 import config
 import melbank
 
 
+class FilterBank:
+    """State of many exponential smoothing filters in one contiguous array
+
+    Every element has its own rise and decay factors, so any contiguous range
+    of filters is updated in a single in-place vectorized pass, even when the
+    filters in that range smooth differently. Filters are usually created as
+    ExpFilter views of a bank. Scratch buffers are allocated once per
+    element, which keeps updates allocation-free and lets disjoint ranges be
+    updated independently.
+    """
+    def __init__(self):
+        self.value = np.zeros(0)
+        self.alpha_decay = np.zeros(0)
+        self.alpha_rise = np.zeros(0)
+        self._delta = np.zeros(0)
+        self._alpha = np.zeros(0)
+        self._rising = np.zeros(0, dtype=bool)
+        self._views = {}
+
+    def __len__(self):
+        return len(self.value)
+
+    def add(self, val, alpha_decay, alpha_rise):
+        """Appends filters with the initial state val
+
+        Returns the (start, stop) range of the new filters. The arrays of the
+        bank are reallocated, so views of them taken earlier become stale.
+        """
+        val = np.ravel(np.asarray(val, dtype=float))
+        start = len(self.value)
+        stop = start + len(val)
+        self.value = np.concatenate((self.value, val))
+        self.alpha_decay = np.concatenate(
+            (self.alpha_decay, np.broadcast_to(alpha_decay, val.shape)))
+        self.alpha_rise = np.concatenate(
+            (self.alpha_rise, np.broadcast_to(alpha_rise, val.shape)))
+        self._delta = np.zeros(stop)
+        self._alpha = np.zeros(stop)
+        self._rising = np.zeros(stop, dtype=bool)
+        self._views = {}
+        return start, stop
+
+    def view(self, start=0, stop=None, shape=None):
+        """Returns the state of the filters in [start, stop) as an array"""
+        return self._range(start, stop, shape)[0]
+
+    def _range(self, start, stop, shape):
+        """Returns views of the state and scratch arrays of a range of filters"""
+        key = start, stop, shape
+        views = self._views.get(key)
+        if views is None:
+            stop = len(self.value) if stop is None else stop
+            views = tuple(a[start:stop] if shape is None else a[start:stop].reshape(shape)
+                          for a in (self.value, self._delta, self._alpha,
+                                    self._rising, self.alpha_decay, self.alpha_rise))
+            self._views[key] = views
+        return views
+
+    def update(self, value, start=0, stop=None, shape=None):
+        """Updates the filters in [start, stop) with new values
+
+        Parameters
+        ----------
+        value : float or np.array
+            New values, broadcast against the state of the filters. NumPy
+            allocates a temporary when an array is broadcast, so pass one
+            value per filter to keep the update allocation-free.
+        start, stop : int
+            Range of filters to update. Default: every filter.
+        shape : tuple, optional
+            Shape that the range is viewed as, so that value can be
+            broadcast along one of its axes.
+
+        Returns
+        -------
+        state : np.array
+            View of the updated state of the filters.
+        """
+        state, delta, alpha, rising, decay, rise = self._range(start, stop, shape)
+        # state + alpha * (value - state), computed in place
+        np.subtract(value, state, out=delta)
+        np.greater(delta, 0.0, out=rising)
+        np.copyto(alpha, decay)
+        np.copyto(alpha, rise, where=rising)
+        delta *= alpha
+        state += delta
+        return state
+
+
 class ExpFilter:
-    """Simple exponential smoothing filter"""
-    def __init__(self, val=0.0, alpha_decay=0.5, alpha_rise=0.5):
+    """Simple exponential smoothing filter
+
+    The filter is a view of a range of a FilterBank, by default a bank of its
+    own. Array values are updated in place, so the array returned by
+    update() is overwritten by the next update.
+    """
+    def __init__(self, val=0.0, alpha_decay=0.5, alpha_rise=0.5, bank=None):
         """Small rise / decay factors = more smoothing"""
         assert 0.0 < alpha_decay < 1.0, 'Invalid decay smoothing factor'
         assert 0.0 < alpha_rise < 1.0, 'Invalid rise smoothing factor'
         self.alpha_decay = alpha_decay
         self.alpha_rise = alpha_rise
-        self.value = val
+        self.bank = FilterBank() if bank is None else bank
+        self.shape = np.shape(val)
+        self.start, self.stop = self.bank.add(val, alpha_decay, alpha_rise)
+
+    @property
+    def value(self):
+        """Current state, a float or a view of the bank"""
+        if not self.shape:
+            return float(self.bank.value[self.start])
+        return self.bank.view(self.start, self.stop, self.shape)
+
+    @value.setter
+    def value(self, val):
+        self.bank.value[self.start:self.stop] = np.ravel(val)
 
     def update(self, value):
-        if isinstance(self.value, (list, np.ndarray, tuple)):
-            alpha = value - self.value
-            alpha[alpha > 0.0] = self.alpha_rise
-            alpha[alpha <= 0.0] = self.alpha_decay
+        if not self.shape:
+            # NumPy calls cost more than the arithmetic for a single value
+            state = float(self.bank.value[self.start])
+            alpha = self.alpha_rise if value > state else self.alpha_decay
+            state = alpha * value + (1.0 - alpha) * state
+            self.bank.value[self.start] = state
+            return state
+        return self.bank.update(value, self.start, self.stop, self.shape)
+
+
+def fast_fft_size(n):
+    """Returns the smallest even FFT length of at least n samples that is 5-smooth
+
+    FFTs whose length has no prime factors other than 2, 3 and 5 are about
+    as fast as FFTs of a power of two, so windows are padded much less than
+    to the next power of two. The length is even, so the rfft bins run up
+    to exactly half the sample rate.
+    """
+    size = max(2, int(n) + int(n) % 2)
+    while True:
+        rest = size // 2
+        for factor in (2, 3, 5):
+            while rest % factor == 0:
+                rest //= factor
+        if rest == 1:
+            return size
+        size += 2
+
+
+class AudioWindow:
+    """Rolling window of audio samples backed by a preallocated ring buffer
+
+    New samples are written in place into a mirrored ring, so the most recent
+    `size` samples are always available as one contiguous view. Windowing,
+    zero padding and the FFT all write into buffers that are allocated once.
+
+    With n_channels, every channel is a row of 2D arrays and all channels
+    are windowed and transformed together in one batched pass.
+    """
+    def __init__(self, size, fft_size=None, window=np.hamming, n_channels=None):
+        self.size = size
+        if fft_size is None:
+            fft_size = fast_fft_size(size)
+        assert fft_size >= size, 'FFT size must not be smaller than the window'
+        self.fft_size = fft_size
+        self.n_channels = n_channels
+        shape = () if n_channels is None else (n_channels,)
+        # One copy per channel, so no broadcasting is needed
+        self.window = np.tile(window(size).astype(np.float32), shape + (1,))
+        # Every sample is stored twice so that the window never wraps around
+        self._ring = np.zeros(shape + (2 * size,), dtype=np.float32)
+        self._pos = 0
+        # Zero padding after the windowed samples is written only once
+        self.fft_input = np.zeros(shape + (fft_size,), dtype=np.float32)
+        self._fft_output = np.fft.rfft(self.fft_input)
+        self.magnitude = np.zeros(self._fft_output.shape)
+        try:
+            np.fft.rfft(self.fft_input, out=self._fft_output)
+            self._fft_has_out = True
+        except TypeError:
+            # NumPy < 2.0 has no output argument for the FFT
+            self._fft_has_out = False
+
+    @property
+    def samples(self):
+        """Contiguous view of the most recent samples, oldest first"""
+        return self._ring[..., self._pos:self._pos + self.size]
+
+    def push(self, samples, scale=1.0):
+        """Appends new samples to the window, scaling them in place
+
+        Samples of several channels are (n_channels, n) arrays.
+        """
+        samples = samples[..., -self.size:]
+        n = samples.shape[-1]
+        first = min(n, self.size - self._pos)
+        for start, src in ((self._pos, samples[..., :first]), (0, samples[..., first:])):
+            stop = start + src.shape[-1]
+            if scale == 1.0:
+                self._ring[..., start:stop] = src
+            else:
+                np.multiply(src, scale, out=self._ring[..., start:stop])
+            self._ring[..., start + self.size:stop + self.size] = self._ring[..., start:stop]
+        self._pos = (self._pos + n) % self.size
+
+    def peak(self):
+        """Returns the largest absolute sample value in the window"""
+        samples = self.samples
+        return max(samples.max(), -samples.min())
+
+    def spectrum(self):
+        """Returns the FFT magnitudes of the windowed, zero padded samples"""
+        np.multiply(self.samples, self.window, out=self.fft_input[..., :self.size])
+        if self._fft_has_out:
+            np.fft.rfft(self.fft_input, out=self._fft_output)
         else:
-            alpha = self.alpha_rise if value > self.value else self.alpha_decay
-        self.value = alpha * value + (1.0 - alpha) * self.value
-        return self.value
+            self._fft_output[:] = np.fft.rfft(self.fft_input)
+        return np.abs(self._fft_output, out=self.magnitude)
+
+
+CHANNELS = ('mono', 'left', 'right', 'stereo', 'all')
+"""Ways of turning multi-channel audio into the samples that are analysed"""
+
+
+def downmix(frames, channels='mono', out=None, scale=1.0):
+    """Converts (n, n_channels) interleaved frames to float32 samples
+
+    'mono' averages every channel, 'left' and 'right' select the first and
+    second channel (the only channel of mono input), 'stereo' returns both
+    of them as (2, n) rows and 'all' keeps every channel as (n_channels, n)
+    rows. Only the given frames are converted, into out when it is given,
+    and multiplied by scale.
+    """
+    n, n_channels = frames.shape
+    if out is None:
+        rows = {'all': (n_channels,), 'stereo': (2,)}.get(channels, ())
+        out = np.zeros(rows + (n,), dtype=np.float32)
+    if channels == 'mono':
+        # Channel by channel, a reduction along the short axis is much slower
+        np.copyto(out, frames[:, 0], casting='unsafe')
+        for column in range(1, n_channels):
+            np.add(out, frames[:, column], out=out)
+        scale /= n_channels
+    elif channels == 'all':
+        np.copyto(out, frames.T, casting='unsafe')
+    elif channels == 'stereo':
+        np.copyto(out[0], frames[:, 0], casting='unsafe')
+        np.copyto(out[1], frames[:, min(1, n_channels - 1)], casting='unsafe')
+    elif channels in ('left', 'right'):
+        column = 0 if channels == 'left' else min(1, n_channels - 1)
+        np.copyto(out, frames[:, column], casting='unsafe')
+    else:
+        raise ValueError('Invalid channels: {}'.format(channels))
+    if scale != 1.0:
+        np.multiply(out, np.float32(scale), out=out)
+    return out
+
+
+DECIMATION_PASSBAND = 0.8
+"""Fraction of the decimated Nyquist frequency that MAX_FREQUENCY may reach
+
+The anti-aliasing filter of Decimator is flat up to about this fraction.
+"""
+
+
+def decimation_factor(rate=None, max_frequency=None):
+    """Returns the largest factor that the audio can be decimated by
+
+    The decimated audio still contains every frequency up to MAX_FREQUENCY.
+    Returns 1 when config.DECIMATION is off.
+    """
+    rate = config.MIC_RATE if rate is None else rate
+    max_frequency = config.MAX_FREQUENCY if max_frequency is None else max_frequency
+    if not config.DECIMATION:
+        return 1
+    return max(1, int(rate * DECIMATION_PASSBAND / (2.0 * max_frequency)))
+
+
+class Decimator:
+    """Streaming low-pass filter and downsampler with a polyphase FIR filter
+
+    Only every factor-th output of the anti-aliasing filter is kept, so only
+    those are computed: the inputs of every kept output are gathered into a
+    row of a matrix, which is multiplied with the filter taps in a single
+    matrix-vector product. The last inputs of every block are kept for the
+    next one, so blocks of any length give the same output as the whole
+    stream at once.
+
+    Parameters
+    ----------
+    factor : int
+        Decimation factor.
+    max_block : int
+        Largest number of samples passed to process() at once.
+    n_channels : int, optional
+        Number of rows of (n_channels, n) blocks.
+    taps_per_phase : int
+        Filter taps per output sample. More taps give a steeper filter.
+    """
+    def __init__(self, factor, max_block, n_channels=None, taps_per_phase=16):
+        self.factor = factor
+        n_taps = factor * taps_per_phase
+        # Windowed sinc with its cutoff at the decimated Nyquist frequency
+        t = np.arange(n_taps) - (n_taps - 1) / 2.0
+        taps = np.sinc(t / factor) * np.hamming(n_taps)
+        # Reversed, so the product with oldest-first inputs is the convolution
+        self.taps = (taps / taps.sum())[::-1].astype(np.float32)
+        shape = () if n_channels is None else (n_channels,)
+        max_out = max_block // factor + 1
+        self._history = n_taps - 1
+        # Room for the last window of every phase
+        self._buffer = np.zeros(shape + (self._history + max_block + factor,), dtype=np.float32)
+        # The rows of a strided view overlap, which NumPy cannot pass to BLAS,
+        # so they are copied into a contiguous matrix first
+        self._rows = np.zeros(shape + (max_out, n_taps), dtype=np.float32)
+        self._out = np.zeros(shape + (max_out,), dtype=np.float32)
+        # The inputs of the outputs of every phase, as strided views of the
+        # buffer, which are slow to create
+        stride = self._buffer.strides[-1]
+        self._windows = [np.lib.stride_tricks.as_strided(
+            self._buffer[..., phase:], shape=shape + (max_out, n_taps),
+            strides=self._buffer.strides[:-1] + (factor * stride, stride), writeable=False)
+            for phase in range(factor)]
+        self._phase = 0
+        """Index in the buffer of the oldest input of the next output, below factor"""
+
+    def process(self, samples):
+        """Returns the decimated samples of a block, as a view of a reused buffer"""
+        buffer = self._buffer
+        total = self._history + samples.shape[-1]
+        buffer[..., self._history:total] = samples
+        first = self._phase
+        count = max(0, (total - len(self.taps) - first) // self.factor + 1)
+        rows = self._rows[..., :count, :]
+        np.copyto(rows, self._windows[first][..., :count, :])
+        out = np.matmul(rows, self.taps, out=self._out[..., :count])
+        # Keep the inputs that the next outputs still need
+        shift = total - self._history
+        buffer[..., :self._history] = buffer[..., shift:total]
+        self._phase = first + count * self.factor - shift
+        return out
+
+
+def rolling_windows(samples, hop, size):
+    """Returns every rolling window of a recording as rows of a 2D view
+
+    Row k holds the `size` samples that end after k + 1 blocks of `hop`
+    samples, which is what AudioWindow contains after the same blocks were
+    pushed into it. The recording is zero padded at the start, and the rows
+    share memory with it. A (n_channels, n) recording gives a
+    (n_channels, n_frames, size) view.
+    """
+    padding = np.zeros(samples.shape[:-1] + (size - hop,), dtype=samples.dtype)
+    samples = np.concatenate((padding, samples), axis=-1)
+    n_frames = (samples.shape[-1] - size) // hop + 1
+    stride = samples.strides[-1]
+    return np.lib.stride_tricks.as_strided(samples,
+                                           shape=samples.shape[:-1] + (n_frames, size),
+                                           strides=samples.strides[:-1] + (hop * stride, stride),
+                                           writeable=False)
+
+
+def batch_spectrum(frames, fft_size=None, window=np.hamming):
+    """Returns the FFT magnitudes of many windows of samples in one pass
+
+    Parameters
+    ----------
+    frames : ndarray
+        (..., n_frames, size) array with one window of samples per row.
+    fft_size : int, optional
+        Zero padded FFT length. Default: fast_fft_size() of the window.
+    """
+    size = frames.shape[-1]
+    if fft_size is None:
+        fft_size = fast_fft_size(size)
+    windowed = frames * window(size).astype(np.float32)
+    return np.abs(np.fft.rfft(windowed, n=fft_size, axis=-1))
 
 
 def rfft(data, window=None):
@@ -39,15 +399,187 @@ def fft(data, window=None):
     return xs, ys
 
 
-def create_mel_bank():
-    global samples, mel_y, mel_x
-    samples = int(config.MIC_RATE * config.N_ROLLING_HISTORY / (2.0 * config.FPS))
-    mel_y, (_, mel_x) = melbank.compute_melmat(num_mel_bands=config.N_FFT_BINS,
-                                               freq_min=config.MIN_FREQUENCY,
-                                               freq_max=config.MAX_FREQUENCY,
-                                               num_fft_bands=samples,
-                                               sample_rate=config.MIC_RATE)
+_MAX_CACHED_BATCH = 16
+"""Largest batch of spectra whose work buffers SparseMelBank keeps"""
+
+
+class SparseMelBank:
+    """Mel filterbank stored as the non-zero run of FFT bins of every band
+
+    Each triangular filter only covers a short run of FFT bins, so instead of
+    multiplying the spectrum with the full (bands x bins) matrix we gather
+    the covered bins, weight them and sum each band with np.add.reduceat.
+    """
+    def __init__(self, melmat):
+        self.melmat = melmat = np.asarray(melmat)
+        self.n_bands, self.n_fft_bins = melmat.shape
+        nonzero = melmat != 0.0
+        self.empty = ~nonzero.any(axis=1)
+        start = np.where(self.empty, 0, nonzero.argmax(axis=1))
+        stop = np.where(self.empty, 0,
+                        self.n_fft_bins - nonzero[:, ::-1].argmax(axis=1))
+        self.start = start
+        self.stop = stop
+        lengths = stop - start
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        band = np.repeat(np.arange(self.n_bands), lengths)
+        self.index = np.concatenate([np.arange(a, b) for a, b in zip(start, stop)])
+        self.weights = melmat[band, self.index]
+        # One trailing zero keeps every offset a valid reduceat index
+        self._work = np.zeros(len(self.index) + 1)
+        self._works = {}
+        """Work buffers of small batches, such as one spectrum per audio channel"""
+
+    def project(self, ys, out=None):
+        """Returns the energy of every mel band for the given FFT magnitudes
+
+        Parameters
+        ----------
+        ys : ndarray
+            FFT magnitudes, at least n_fft_bins long along the last axis.
+        out : ndarray, optional
+            Preallocated output array with n_bands values along the last axis.
+        """
+        ys = np.asarray(ys, dtype=self._work.dtype)
+        if ys.ndim == 1:
+            work = self._work[:-1]
+            np.take(ys, self.index, out=work)
+            work *= self.weights
+            work = self._work
+        else:
+            shape = ys.shape[:-1]
+            if shape in self._works:
+                work, weights = self._works[shape]
+            else:
+                work = np.zeros(shape + (len(self.index) + 1,))
+                weights = np.tile(self.weights, shape + (1,))
+                if np.prod(shape) <= _MAX_CACHED_BATCH:
+                    self._works[shape] = work, weights
+            np.take(ys, self.index, axis=-1, out=work[..., :-1], mode='clip')
+            work[..., :-1] *= weights
+        out = np.add.reduceat(work, self.offsets, axis=-1, out=out)
+        out[..., self.empty] = 0.0
+        return out
+
+
+MEL_CACHE_SIZE = 8
+"""Number of mel filterbank matrices that MelCache keeps"""
+
+
+class MelCache:
+    """Least recently used mel filterbank matrices, persisted to a file
+
+    Matrices are keyed by (sample rate, FFT length, number of bands, minimum
+    frequency, maximum frequency). The file is rewritten whenever a matrix
+    is computed, so the next start or frequency change finds it ready. The
+    cache is shared by threads that build filterbanks.
+    """
+    def __init__(self, path=None, size=MEL_CACHE_SIZE):
+        self.path = path
+        self.size = size
+        self._matrices = collections.OrderedDict()
+        self._loaded = path is None
+        self._lock = threading.Lock()
+
+    def get(self, rate, fft_size, n_bands, min_frequency, max_frequency):
+        """Returns the (n_bands, fft_size // 2 + 1) mel filterbank matrix"""
+        key = (float(rate), int(fft_size), int(n_bands),
+               float(min_frequency), float(max_frequency))
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            melmat = self._matrices.pop(key, None)
+            computed = melmat is None
+            if computed:
+                melmat, _ = melbank.compute_melmat(num_mel_bands=key[2],
+                                                   freq_min=key[3],
+                                                   freq_max=key[4],
+                                                   num_fft_bands=key[1] // 2 + 1,
+                                                   sample_rate=key[0])
+            # The most recently used matrix is the last one
+            self._matrices[key] = melmat
+            while len(self._matrices) > self.size:
+                self._matrices.popitem(last=False)
+            if computed and self.path is not None:
+                self._save()
+        return melmat
+
+    def _load(self):
+        """Reads the matrices of the file, if there is a valid one
+
+        Loading is best-effort: a missing, truncated or corrupt file, which
+        may fail anywhere from the zip directory to decompression, leaves
+        the cache empty, and the matrices are computed and saved again.
+        """
+        self._loaded = True
+        try:
+            with np.load(self.path) as f:
+                keys = f['keys']
+                matrices = [f['melmat_{}'.format(i)] for i in range(len(keys))]
+            entries = [((float(rate), int(fft_size), int(n_bands),
+                         float(min_frequency), float(max_frequency)), melmat)
+                       for (rate, fft_size, n_bands, min_frequency, max_frequency), melmat
+                       in zip(keys, matrices)]
+        except Exception:
+            return
+        self._matrices.update(entries)
+
+    def _save(self):
+        """Writes the matrices atomically, so a crash never leaves a partial file"""
+        arrays = {'melmat_{}'.format(i): m for i, m in enumerate(self._matrices.values())}
+        arrays['keys'] = np.array(list(self._matrices), dtype=float)
+        tmp = None
+        try:
+            # A file of its own, as zone workers may save at the same time
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix='mel_cache-',
+                                       dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'wb') as f:
+                # Mostly zeros, which compress well
+                np.savez_compressed(f, **arrays)
+            getattr(os, 'replace', os.rename)(tmp, self.path)
+        except (IOError, OSError) as e:
+            print('Failed to save the mel filterbank cache: {}'.format(e))
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+
+mel_cache = MelCache(config.MEL_CACHE_PATH)
+"""Mel filterbank matrices of recent sample rates, FFT lengths and frequency ranges"""
+
+
+def build_mel_bank(rate, fft_size, min_frequency=None, max_frequency=None):
+    """Returns a new SparseMelBank for spectra of the given FFT length
+
+    The bands cover min_frequency to max_frequency, by default MIN_FREQUENCY
+    and MAX_FREQUENCY, whatever the sample rate and FFT length, so decimated
+    audio gives the same bands. Safe to call from any thread: nothing is
+    shared with filterbanks in use.
+    """
+    min_frequency = config.MIN_FREQUENCY if min_frequency is None else min_frequency
+    max_frequency = config.MAX_FREQUENCY if max_frequency is None else max_frequency
+    return SparseMelBank(mel_cache.get(rate, fft_size, config.N_FFT_BINS,
+                                       min_frequency, max_frequency))
+
+
+def create_mel_bank(rate=None, fft_size=None):
+    """Builds the mel filterbank of this module for the given FFT length
+
+    The default is the undecimated audio at config.MIC_RATE in windows of
+    N_ROLLING_HISTORY frames, padded to fast_fft_size().
+    """
+    global samples, mel_y, mel_x, mel_bank
+    if rate is None:
+        rate = config.MIC_RATE
+    if fft_size is None:
+        fft_size = fast_fft_size(int(config.MIC_RATE / config.FPS) * config.N_ROLLING_HISTORY)
+    bank = build_mel_bank(rate, fft_size)
+    # Number of rfft bins, which run from 0 Hz to half the sample rate
+    samples = fft_size // 2 + 1
+    mel_y = bank.melmat
+    mel_x = np.linspace(0.0, rate / 2.0, samples)
+    mel_bank = bank
 samples = None
 mel_y = None
 mel_x = None
-create_mel_bank()
\ No newline at end of file
+mel_bank = None
+"""Mel filterbank, built by create_mel_bank() for the analysed sample rate and FFT length"""
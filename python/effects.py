@@ -0,0 +1,313 @@
+"""Visualization effects that map the audio features of a frame onto the LED strip"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+from scipy.ndimage import correlate1d
+import config
+import dsp
+import analysis
+
+
+def _gaussian_kernel(sigma, truncate=4.0):
+    """Returns the weights used by gaussian_filter1d for the given sigma"""
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * x**2 / sigma**2)
+    return kernel / kernel.sum()
+
+
+class Effect:
+    """Base class of the visualization effects
+
+    An effect owns all of its state, so switching between effects never
+    leaks state from one into another. Its buffers are allocated by resize()
+    and every frame is rendered in place into them, so rendering a frame
+    allocates no memory.
+
+    Effects are symmetric: render() draws one half of the strip, starting at
+    the center, and the base class mirrors it into the output frame.
+    Subclasses implement allocate(), reset() and render(). Effects only read
+    the analysis.Features of the frame, which are computed once for every
+    effect, so they do no audio analysis of their own.
+    """
+    def __init__(self, n_pixels=None, n_bins=None):
+        self.resize(config.N_PIXELS if n_pixels is None else n_pixels,
+                    config.N_FFT_BINS if n_bins is None else n_bins)
+
+    def resize(self, n_pixels, n_bins):
+        """Allocates the buffers for a strip length and number of mel bands"""
+        self.n_pixels = n_pixels
+        self.n_bins = n_bins
+        self.half = n_pixels // 2
+        self.output = np.zeros((3, n_pixels))
+        self.half_buffer = np.zeros((3, self.half))
+        """Half of the frame drawn by render_half(), starting at the center"""
+        self.allocate()
+        self.reset()
+
+    def allocate(self):
+        """Allocates the buffers of the effect, called by resize()"""
+        pass
+
+    def reset(self):
+        """Restores the initial state of the effect"""
+        pass
+
+    def render(self, features, half):
+        """Draws the (3, n_pixels // 2) half of the frame for the audio features"""
+        raise NotImplementedError
+
+    def render_half(self, features):
+        """Renders the half of the frame for the audio features and returns it
+
+        The half starts at the center of the strip. It is written to
+        self.half_buffer, which is overwritten by the next frame.
+        """
+        self.render(features, self.half_buffer)
+        return self.half_buffer
+
+    def __call__(self, features, out=None):
+        """Renders a frame and returns it
+
+        Parameters
+        ----------
+        features : analysis.Features
+            Audio features of the frame, with n_bins mel energies.
+        out : np.array, optional
+            (3, n_pixels) array that the frame is written to. By default the
+            frame is written to self.output, which is overwritten by the
+            next frame.
+        """
+        out = self.output if out is None else out
+        half = self.render_half(features)
+        # Mirror the color channels for symmetric output
+        out[:, :self.half] = half[:, ::-1]
+        out[:, self.half:2 * self.half] = half
+        out[:, 2 * self.half:] = 0.0
+        return out
+
+
+class Scroll(Effect):
+    """Effect that originates in the center and scrolls outwards"""
+    def allocate(self):
+        self._p = np.zeros((3, self.half))
+        self._shifted = np.zeros((3, self.half))
+        self._kernel = _gaussian_kernel(0.2)
+
+    def reset(self):
+        self._p[:] = 1.0
+
+    def render(self, features, half):
+        # Color channels from the loudest low, mid and high frequencies
+        low, mid, high = features.peaks.tolist()
+        r = int(255.0 * low * low)
+        g = int(255.0 * mid * mid)
+        b = int(255.0 * high * high)
+        # Scrolling effect window
+        p = self._p
+        self._shifted[:, 0] = p[:, 0]
+        self._shifted[:, 1:] = p[:, :-1]
+        self._shifted *= 0.98
+        correlate1d(self._shifted, self._kernel, axis=1, output=p, mode='reflect')
+        # Create new color originating at the center
+        p[0, 0] = r
+        p[1, 0] = g
+        p[2, 0] = b
+        half[:] = p
+
+
+class Energy(Effect):
+    """Effect that expands from the center with increasing sound energy"""
+    def allocate(self):
+        self._p = np.zeros((3, self.half))
+        self._kernel = _gaussian_kernel(4.0)
+
+    def reset(self):
+        self.p_filt = dsp.ExpFilter(np.tile(1.0, (3, self.half)),
+                                    alpha_decay=0.1, alpha_rise=0.99)
+
+    def render(self, features, half):
+        # Map color channels according to energy in the different freq bands,
+        # scaled by the width of the LED strip
+        width = float(self.half - 1)
+        low, mid, high = features.bands.tolist()
+        r = int((width * low)**0.9)
+        g = int((width * mid)**0.9)
+        b = int((width * high)**0.9)
+        # Assign color to different frequency regions
+        p = self._p
+        p[0, :r] = 255.0
+        p[0, r:] = 0.0
+        p[1, :g] = 255.0
+        p[1, g:] = 0.0
+        p[2, :b] = 255.0
+        p[2, b:] = 0.0
+        self.p_filt.update(p)
+        np.rint(self.p_filt.value, out=p)
+        # Apply substantial blur to smooth the edges
+        correlate1d(p, self._kernel, axis=1, output=half, mode='reflect')
+
+
+class Spectrum(Effect):
+    """Effect that maps the Mel filterbank frequencies onto the LED strip"""
+    def allocate(self):
+        # Linear interpolation of the mel bands onto half of the strip
+        x = np.linspace(0, self.n_bins - 1, self.half)
+        left = np.clip(np.floor(x).astype(int), 0, max(self.n_bins - 2, 0))
+        right = np.minimum(left + 1, self.n_bins - 1)
+        # Indices into the flattened (mel, delta) spectra of the features:
+        # the mel energies twice, as the input of both common_mode and
+        # b_filt, then their change since the previous frame
+        n = self.n_bins
+        self._left = np.stack((left, left, left + n))
+        self._right = np.stack((right, right, right + n))
+        self._fraction = np.tile(x - left, (3, 1))
+        self._y = np.zeros((3, self.half))
+        self._step = np.zeros((3, self.half))
+        self._r = np.zeros(self.half)
+
+    def reset(self):
+        # common_mode and b_filt smooth the same input, so they are adjacent
+        # in the bank and updated together
+        self.filters = dsp.FilterBank()
+        self.common_mode = dsp.ExpFilter(np.tile(0.01, self.half),
+                                         alpha_decay=0.99, alpha_rise=0.01,
+                                         bank=self.filters)
+        self.b_filt = dsp.ExpFilter(np.tile(0.01, self.half),
+                                    alpha_decay=0.1, alpha_rise=0.5,
+                                    bank=self.filters)
+        self.r_filt = dsp.ExpFilter(np.tile(0.01, self.half),
+                                    alpha_decay=0.2, alpha_rise=0.99,
+                                    bank=self.filters)
+
+    def render(self, features, half):
+        y3 = np.take(features.spectra, self._left, out=self._y, mode='clip')
+        step = np.take(features.spectra, self._right, out=self._step, mode='clip')
+        step -= y3
+        step *= self._fraction
+        y3 += step
+        y = y3[0]
+        y2 = y3[:2]
+        common_mode, b = self.filters.update(y2, self.common_mode.start,
+                                             self.b_filt.stop, y2.shape)
+        # Color channel mappings
+        np.subtract(y, common_mode, out=self._r)
+        half[0] = self.r_filt.update(self._r)
+        # Interpolating the change is the same as the change of the interpolation
+        np.abs(y3[2], out=half[1])
+        half[2] = b
+        half *= 255.0
+
+
+class Stereo(Effect):
+    """Draws the left half of the strip from the left audio channel and the
+    right half from the right channel
+
+    Each half has its own instance of the effect, so the halves never share
+    state. Takes stereo analysis.Features with a row per channel. The halves
+    are not mirrored, so __call__() replaces the symmetric rendering of the
+    base class.
+    """
+    def __init__(self, effect, n_pixels=None, n_bins=None):
+        self.effect = effect
+        Effect.__init__(self, n_pixels, n_bins)
+
+    def allocate(self):
+        self.left = self.effect(self.n_pixels, self.n_bins)
+        self.right = self.effect(self.n_pixels, self.n_bins)
+
+    def reset(self):
+        self.left.reset()
+        self.right.reset()
+
+    def __call__(self, features, out=None):
+        out = self.output if out is None else out
+        half = self.half
+        left = self.left.render_half(features.channel(0))
+        right = self.right.render_half(features.channel(1))
+        # The left half grows from the center towards the left end
+        out[:, :half] = left[:, ::-1]
+        out[:, half:2 * half] = right
+        out[:, 2 * half:] = 0.0
+        return out
+
+
+EFFECTS = {'scroll': Scroll, 'energy': Energy, 'spectrum': Spectrum}
+"""Effect classes by name"""
+
+
+def create(name, n_pixels=None, n_bins=None, stereo=None):
+    """Returns a new instance of the effect with the given name
+
+    Stereo effects are created when AUDIO_CHANNELS is 'stereo', unless
+    stereo is given.
+    """
+    if stereo is None:
+        stereo = config.AUDIO_CHANNELS == 'stereo'
+    if stereo:
+        return Stereo(EFFECTS[name], n_pixels, n_bins)
+    return EFFECTS[name](n_pixels, n_bins)
+
+
+def _traced(effect, features, out):
+    """Returns the bytes retained and the peak bytes of rendering the features
+
+    Measured over two runs of the same frames: memory that is still
+    allocated after a frame shows up as growth between the two runs. Only
+    the first element of every tracemalloc result is kept, as holding the
+    returned tuples would count as retained memory too.
+    """
+    import tracemalloc
+    tracemalloc.start()
+    for y in features:
+        effect(y, out)
+    first = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for y in features:
+        effect(y, out)
+    second = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return second[0] - first, second[1] - second[0]
+
+
+def benchmark(frames=1000, warmup=100):
+    """Prints the time and memory allocated per frame for every effect
+
+    Returns the names of the effects that retain memory from frame to frame,
+    which should be none: every array an effect needs is allocated when it
+    is created. The peak is the most memory that was allocated at once while
+    rendering. It only holds Python scalars and short-lived NumPy views and
+    scalar temporaries, so it stays the same for any number of pixels.
+    """
+    import time
+    mel = np.random.RandomState(0).rand(warmup + frames, config.N_FFT_BINS)
+    extractor = analysis.FeatureExtractor()
+    features = [extractor.extract(y) for y in mel]
+    rows = features[warmup:]
+    out = np.zeros((3, config.N_PIXELS))
+    print('Frame buffer: {} bytes'.format(out.nbytes))
+    allocating = []
+    for name in sorted(EFFECTS):
+        # The features are mono, whatever AUDIO_CHANNELS is
+        effect = create(name, stereo=False)
+        for y in features[:warmup]:
+            effect(y, out)
+        start = time.time()
+        for y in rows:
+            effect(y, out)
+        elapsed = time.time() - start
+        # Tracing slows everything down, so it is measured separately
+        retained, peak = _traced(effect, rows, out)
+        print('{:10} {:6.1f} us/frame, {:.2f} bytes/frame retained, {} bytes peak'.format(
+            name, 1e6 * elapsed / frames, retained / frames, peak))
+        if retained > 0:
+            allocating.append(name)
+    return allocating
+
+
+if __name__ == '__main__':
+    import sys
+    allocating = benchmark()
+    if allocating:
+        print('Effects that allocate memory every frame: {}'.format(', '.join(allocating)))
+        sys.exit(1)
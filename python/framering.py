@@ -0,0 +1,139 @@
+"""Shared-memory ring of the latest frames for the out-of-process GUI
+
+The real-time loop writes every frame into the next slot of a ring that is
+memory-mapped by both processes, then publishes the slot by bumping a
+sequence counter. The GUI process polls the counter at its own refresh rate
+and only reads the most recently published slot, so the real-time loop never
+waits on the GUI.
+
+The GUI runs as a separate Python interpreter, so it never imports the
+real-time modules. User input travels back as one JSON message per line on
+the GUI's standard output.
+
+Layout of the mapped file:
+    |sequence (uint64)|slot 0|slot 1|...
+where every slot is one float32 record:
+    |has_mel|mel (n_fft_bins values)|pixels (3 * n_pixels values)|
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+_SLOTS = 4
+"""Number of slots, so the reader has several frames of time to copy a slot"""
+
+_HEADER = 8
+"""Bytes in front of the slots, holding the sequence counter"""
+
+
+class FrameRing:
+    """Single-writer, single-reader ring of (mel, pixels) frames"""
+    def __init__(self, n_fft_bins, n_pixels, path=None, slots=_SLOTS):
+        """Creates a new ring, or attaches to an existing one if path is given"""
+        self.n_fft_bins = n_fft_bins
+        self.n_pixels = n_pixels
+        self.slots = slots
+        self.record_size = 1 + n_fft_bins + 3 * n_pixels
+        self.owner = path is None
+        if self.owner:
+            fd, path = tempfile.mkstemp(prefix='led-frames-')
+            os.close(fd)
+            mode = 'w+'
+        else:
+            mode = 'r'
+        self.path = path
+        self._sequence = np.memmap(path, dtype=np.uint64, mode=mode, shape=(1,))
+        self._records = np.memmap(path, dtype=np.float32, mode=mode,
+                                  offset=_HEADER,
+                                  shape=(slots, self.record_size))
+
+    @property
+    def sequence(self):
+        """Number of frames written so far"""
+        return int(self._sequence[0])
+
+    def write(self, mel, pixels):
+        """Publishes a frame. mel may be None when there is no audio"""
+        seq = self.sequence + 1
+        record = self._records[seq % self.slots]
+        if mel is None:
+            record[0] = 0.0
+        else:
+            record[0] = 1.0
+            record[1:1 + self.n_fft_bins] = mel
+        record[1 + self.n_fft_bins:] = np.ravel(pixels)
+        self._sequence[0] = seq
+
+    def read(self):
+        """Returns a copy of the latest frame as (sequence, mel, pixels)"""
+        seq = self.sequence
+        record = np.array(self._records[seq % self.slots])
+        mel = record[1:1 + self.n_fft_bins] if record[0] else None
+        pixels = record[1 + self.n_fft_bins:].reshape(3, self.n_pixels)
+        return seq, mel, pixels
+
+    def close(self):
+        """Unmaps the ring, and deletes its file if this process created it"""
+        if self.path is None:
+            return
+        del self._sequence, self._records
+        if self.owner:
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                # Windows keeps a file that another process still maps
+                print('Failed to delete {}: {}'.format(self.path, e))
+        self.path = None
+
+
+class GUIProcess:
+    """Visualization window running in a separate process"""
+    def __init__(self, frames, settings):
+        """Starts the GUI process
+
+        Parameters
+        ----------
+        frames : FrameRing
+            Ring that the real-time loop writes frames to.
+        settings : dict
+            'mic_rate', 'min_frequency', 'max_frequency' and 'gui_fps'.
+        """
+        settings = dict(settings, n_fft_bins=frames.n_fft_bins,
+                        n_pixels=frames.n_pixels)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), frames.path,
+             json.dumps(settings)],
+            stdout=subprocess.PIPE, universal_newlines=True)
+
+    def messages(self):
+        """Yields the control messages sent by the GUI until it exits
+
+        Messages are tuples: ('effect', name), ('frequency', min_hz, max_hz)
+        or ('chroma_scaled',).
+        """
+        for line in iter(self.process.stdout.readline, ''):
+            try:
+                yield tuple(json.loads(line))
+            except ValueError:
+                # Anything else the GUI process printed
+                sys.stdout.write(line)
+
+
+class _Control:
+    """Sends control messages from the GUI process to the real-time process"""
+    def put(self, message):
+        sys.stdout.write(json.dumps(message) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    # Entry point of the GUI process, Qt is only ever loaded here
+    import gui
+    settings = json.loads(sys.argv[2])
+    frames = FrameRing(settings['n_fft_bins'], settings['n_pixels'], path=sys.argv[1])
+    gui.run_visualization(frames, _Control(), settings)
@@ -2,7 +2,7 @@ from __future__ import print_function
 from __future__ import division
 import time
 import numpy as np
-from pyqtgraph.Qt import QtGui
+from pyqtgraph.Qt import QtGui, QtCore
 import pyqtgraph as pg
 from pyqtgraph.dockarea import *
 
@@ -31,6 +31,154 @@ class GUI:
         self.curve[plot_index].append(self.plot[plot_index].plot(pen=pen))
 
 
+def run_visualization(frames, control, settings):
+    """Runs the visualization window until it is closed
+
+    Frames are read from a framering.FrameRing at settings['gui_fps'] and
+    user input is sent back as messages through control.put().
+
+    Parameters
+    ----------
+    frames : framering.FrameRing
+        Shared memory ring written by the real-time process.
+    control : object
+        Receives ('effect', name), ('frequency', min_hz, max_hz) and
+        ('chroma_scaled',) messages through its put() method.
+    settings : dict
+        'mic_rate', 'min_frequency', 'max_frequency' and 'gui_fps' of the
+        real-time process.
+    """
+    import dsp
+
+    class WutView(pg.GraphicsView):
+      """
+      This cute little view simply adds keyboard controls to the main frame.
+      Just press keys 1, 2 or 3 on your keyboard to switch between modes with the visualisation window focused
+      """
+      def keyPressEvent(self, event):
+        k = event.text()
+        if k == "1":
+          energy_click(0)
+        if k == "2":
+          scroll_click(0)
+        if k == "3":
+          spectrum_click(0)
+        if k == "4":
+          control.put(('chroma_scaled',))
+
+    mic_rate = settings['mic_rate']
+    # Create GUI window
+    app = QtGui.QApplication([])
+    view = WutView()
+    layout = pg.GraphicsLayout(border=(100,100,100))
+    view.setCentralItem(layout)
+    view.show()
+    view.setWindowTitle('Visualization')
+    view.resize(800,600)
+    # Mel filterbank plot
+    fft_plot = layout.addPlot(title='Filterbank Output', colspan=3)
+    fft_plot.setRange(yRange=[-0.1, 1.2])
+    fft_plot.disableAutoRange(axis=pg.ViewBox.YAxis)
+    x_data = np.array(range(1, frames.n_fft_bins + 1))
+    mel_curve = pg.PlotCurveItem()
+    mel_curve.setData(x=x_data, y=x_data*0)
+    fft_plot.addItem(mel_curve)
+    fft_plot_filter = dsp.ExpFilter(np.tile(1e-1, frames.n_fft_bins),
+                                    alpha_decay=0.5, alpha_rise=0.99)
+    mel_x = [np.linspace(settings['min_frequency'], settings['max_frequency'],
+                         frames.n_fft_bins)]
+    # Visualization plot
+    layout.nextRow()
+    led_plot = layout.addPlot(title='Visualization Output', colspan=3)
+    led_plot.setRange(yRange=[-5, 260])
+    led_plot.disableAutoRange(axis=pg.ViewBox.YAxis)
+    # Pen for each of the color channel curves
+    r_pen = pg.mkPen((255, 30, 30, 200), width=4)
+    g_pen = pg.mkPen((30, 255, 30, 200), width=4)
+    b_pen = pg.mkPen((30, 30, 255, 200), width=4)
+    # Color channel curves
+    r_curve = pg.PlotCurveItem(pen=r_pen)
+    g_curve = pg.PlotCurveItem(pen=g_pen)
+    b_curve = pg.PlotCurveItem(pen=b_pen)
+    # Define x data
+    x_data = np.array(range(1, frames.n_pixels + 1))
+    r_curve.setData(x=x_data, y=x_data*0)
+    g_curve.setData(x=x_data, y=x_data*0)
+    b_curve.setData(x=x_data, y=x_data*0)
+    # Add curves to plot
+    led_plot.addItem(r_curve)
+    led_plot.addItem(g_curve)
+    led_plot.addItem(b_curve)
+    # Frequency range label
+    freq_label = pg.LabelItem('')
+    # Frequency slider
+    def freq_slider_change(tick):
+        minf = freq_slider.tickValue(0)**2.0 * (mic_rate / 2.0)
+        maxf = freq_slider.tickValue(1)**2.0 * (mic_rate / 2.0)
+        t = 'Frequency range: {:.0f} - {:.0f} Hz'.format(minf, maxf)
+        freq_label.setText(t)
+        mel_x[0] = np.linspace(minf, maxf, frames.n_fft_bins)
+        control.put(('frequency', minf, maxf))
+    freq_slider = pg.TickSliderItem(orientation='bottom', allowAdd=False)
+    freq_slider.addTick((settings['min_frequency'] / (mic_rate / 2.0))**0.5)
+    freq_slider.addTick((settings['max_frequency'] / (mic_rate / 2.0))**0.5)
+    freq_slider.tickMoveFinished = freq_slider_change
+    freq_label.setText('Frequency range: {} - {} Hz'.format(
+        settings['min_frequency'],
+        settings['max_frequency']))
+    # Effect selection
+    active_color = '#16dbeb'
+    inactive_color = '#FFFFFF'
+    def select_effect(name):
+        control.put(('effect', name))
+        for label_name, label in effect_labels.items():
+            color = active_color if label_name == name else inactive_color
+            label.setText(label_name.capitalize(), color=color)
+    def energy_click(x):
+        select_effect('energy')
+    def scroll_click(x):
+        select_effect('scroll')
+    def spectrum_click(x):
+        select_effect('spectrum')
+    # Create effect "buttons" (labels with click event)
+    energy_label = pg.LabelItem('Energy')
+    scroll_label = pg.LabelItem('Scroll')
+    spectrum_label = pg.LabelItem('Spectrum')
+    effect_labels = {'energy': energy_label, 'scroll': scroll_label,
+                     'spectrum': spectrum_label}
+    energy_label.mousePressEvent = energy_click
+    scroll_label.mousePressEvent = scroll_click
+    spectrum_label.mousePressEvent = spectrum_click
+    energy_click(0)
+    # Layout
+    layout.nextRow()
+    layout.addItem(freq_label, colspan=3)
+    layout.nextRow()
+    layout.addItem(freq_slider, colspan=3)
+    layout.nextRow()
+    layout.addItem(energy_label)
+    layout.addItem(scroll_label)
+    layout.addItem(spectrum_label)
+
+    last_sequence = [0]
+    def refresh():
+        sequence, mel, pixels = frames.read()
+        if sequence == last_sequence[0]:
+            return
+        last_sequence[0] = sequence
+        if mel is not None:
+            # Plot filterbank output
+            mel_curve.setData(x=mel_x[0], y=fft_plot_filter.update(mel))
+        # Plot the color channels
+        r_curve.setData(y=pixels[0])
+        g_curve.setData(y=pixels[1])
+        b_curve.setData(y=pixels[2])
+    timer = QtCore.QTimer()
+    timer.timeout.connect(refresh)
+    timer.start(int(1000 / settings['gui_fps']))
+    app.exec_()
+
+
 if __name__ == '__main__':
     # Example test gui
     N = 48
@@ -0,0 +1,176 @@
+"""Low-overhead latency instrumentation with a local metrics endpoint
+
+Pipeline stages record their durations into rolling histograms, which are
+served in the Prometheus text format on http://127.0.0.1:METRICS_PORT/metrics
+when config.METRICS_PORT is set. Nothing is recorded otherwise.
+
+Example:
+    with metrics.timed('fft'):
+        ys = audio_window.spectrum()
+"""
+from __future__ import print_function
+from __future__ import division
+import threading
+import time
+import numpy as np
+import config
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+clock = getattr(time, 'perf_counter', time.time)
+"""High resolution clock used for all timings"""
+
+monotonic = getattr(time, 'monotonic', time.time)
+"""Monotonic clock used for deadlines and intervals (time.time on Python 2)"""
+
+enabled = config.METRICS_PORT is not None
+"""Whether measurements are recorded"""
+
+QUANTILES = (0.5, 0.95, 0.99)
+"""Quantiles reported for every histogram"""
+
+_WINDOW = 1024
+"""Number of most recent measurements kept by every histogram"""
+
+
+class Histogram:
+    """Rolling window of the most recent measurements"""
+    def __init__(self, size=_WINDOW):
+        self._values = np.zeros(size)
+        self._index = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self._values[self._index] = value
+        self._index = (self._index + 1) % len(self._values)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self, q=QUANTILES):
+        """Returns the given quantiles of the measurements in the window"""
+        n = min(self.count, len(self._values))
+        if n == 0:
+            return [float('nan')] * len(q)
+        return np.percentile(self._values[:n], [100.0 * x for x in q])
+
+
+_histograms = {}
+"""Histograms by (metric name, labels)"""
+
+_gauges = {}
+"""(metric type, function returning the current value) by (metric name, labels)"""
+
+
+_lock = threading.Lock()
+"""Guards adding metrics, so render() sees a consistent snapshot"""
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """Records a measurement in seconds"""
+    if not enabled:
+        return
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(key, Histogram())
+    histogram.observe(value)
+
+
+def gauge(name, function, **labels):
+    """Registers a function that returns the current value of a gauge"""
+    with _lock:
+        _gauges[_key(name, labels)] = ('gauge', function)
+
+
+def counter(name, function, **labels):
+    """Registers a function that returns the current total of a counter"""
+    with _lock:
+        _gauges[_key(name, labels)] = ('counter', function)
+
+
+class timed:
+    """Context manager that records the duration of a stage
+
+    The duration is recorded as led_stage_seconds{stage="<stage>"}.
+    """
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = clock()
+
+    def __exit__(self, *exc):
+        observe('led_stage_seconds', clock() - self.start, stage=self.stage)
+
+
+def _format_labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in items) + '}'
+
+
+def render():
+    """Returns all metrics in the Prometheus text exposition format"""
+    lines = []
+    # Other threads add metrics when they first record them
+    with _lock:
+        histograms = sorted(_histograms.items())
+        gauges = sorted(_gauges.items())
+    names = sorted(set(name for (name, _), _ in histograms))
+    for name in names:
+        lines.append('# TYPE {} summary'.format(name))
+        for (metric, labels), histogram in histograms:
+            if metric != name:
+                continue
+            for q, value in zip(QUANTILES, histogram.quantiles()):
+                lines.append('{}{} {:.9f}'.format(
+                    name, _format_labels(labels, quantile=q), value))
+            lines.append('{}_sum{} {:.9f}'.format(name, _format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram.count))
+    names = sorted(set(name for (name, _), _ in gauges))
+    for name in names:
+        values = [(labels, kind, function)
+                  for (metric, labels), (kind, function) in gauges
+                  if metric == name]
+        lines.append('# TYPE {} {}'.format(name, values[0][1]))
+        for labels, _, function in values:
+            lines.append('{}{} {}'.format(name, _format_labels(labels), function()))
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=None):
+    """Starts the metrics endpoint on a background thread"""
+    port = config.METRICS_PORT if port is None else port
+    server = HTTPServer(('127.0.0.1', port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    print('Serving metrics on http://127.0.0.1:{}/metrics'.format(port))
+    return server
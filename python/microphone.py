@@ -1,49 +1,137 @@
+"""Audio capture from the sound card
+
+PyAudio runs in callback mode: the sound driver hands every block of int16
+frames to a callback on its own thread, which writes it into a preallocated
+CaptureRing. The analysis reads the newest frames from the ring whenever it
+needs them, and only those frames are converted to float and downmixed.
+"""
+import threading
 import time
 import numpy as np
 import pyaudio
 import config
+import dsp
+
+CAPTURE_SECONDS = 1.0
+"""Length of the capture ring, the most audio that can wait to be analysed"""
+
+stream_opened = threading.Event()
+"""Set once start_stream has opened the stream and config.MIC_RATE is final"""
+
+
+class CaptureRing:
+    """Ring of interleaved int16 audio frames without locks
+
+    The audio callback is the only writer and the analysis the only reader.
+    The writer publishes the total number of frames written after every
+    block and the reader remembers how far it has read, so neither ever
+    waits for the other.
+
+    Frames that were not read before newer frames arrived are stale: a
+    reader that fell behind skips straight to the newest frames instead of
+    analysing old audio late.
+    """
+    def __init__(self, n_channels, capacity):
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self._frames = np.zeros((capacity, n_channels), dtype=np.int16)
+        self._flat = self._frames.reshape(-1)
+        self._samples = np.zeros((max(n_channels, 2), capacity), dtype=np.float32)
+        self.written = 0
+        """Total number of frames written"""
+        self.read_position = 0
+        """Total number of frames written when the reader last read"""
+        self.overflows = 0
+        """Number of blocks that the sound driver dropped before they were written"""
+        self.skipped = 0
+        """Number of stale frames that were never read"""
+
+    def write(self, data):
+        """Appends a block of interleaved int16 frames from the sound driver"""
+        block = np.frombuffer(data, dtype=np.int16)[-len(self._flat):]
+        n = len(block) // self.n_channels
+        # Plain copies of the interleaved samples, wrapping around at most once
+        pos = self.written % self.capacity * self.n_channels
+        first = min(len(block), len(self._flat) - pos)
+        self._flat[pos:pos + first] = block[:first]
+        if first < len(block):
+            self._flat[:len(block) - first] = block[first:]
+        # Publish the frames only after they have been written
+        self.written += n
+
+    def read(self, max_frames, channels='mono', scale=1.0):
+        """Returns the frames written since the previous read as float32 samples
+
+        At most the newest max_frames frames are returned, converted and
+        scaled with dsp.downmix. Older unread frames are discarded. The
+        samples are only valid until the next read.
+        """
+        written = self.written
+        n = min(written - self.read_position, max_frames, self.capacity)
+        self.skipped += written - self.read_position - n
+        self.read_position = written
+        rows = {'all': self.n_channels, 'stereo': 2}.get(channels)
+        out = self._samples[0, :n] if rows is None else self._samples[:rows, :n]
+        start = (written - n) % self.capacity
+        first = min(n, self.capacity - start)
+        dsp.downmix(self._frames[start:start + first], channels, out[..., :first], scale)
+        if first < n:
+            dsp.downmix(self._frames[:n - first], channels, out[..., first:], scale)
+        return out
+
+
+def _input_device(p):
+    """Returns the device info and the number of channels to capture"""
+    if config.AUDIO_DEVICE is not None:
+        info = p.get_device_info_by_index(config.AUDIO_DEVICE)
+        return info, info['maxInputChannels']
+    elif config.AUDIO_SOURCE == 'loopback':
+        info = p.get_default_output_device_info()
+        return info, info['maxOutputChannels']
+    elif config.AUDIO_SOURCE == 'mic':
+        info = p.get_default_input_device_info()
+        return info, info['maxInputChannels']
+    raise ValueError('Invalid audio source: {}'.format(config.AUDIO_SOURCE))
 
 
 def start_stream(callback):
+    """Captures audio until the stream ends
+
+    callback(ring) is called from the sound driver's thread after every
+    block of frames has been written to the CaptureRing ring.
+    """
     p = pyaudio.PyAudio()
     frames_per_buffer = int(config.MIC_RATE / config.FPS)
-    if config.AUDIO_SOURCE == 'loopback':
-      wasapi = p.get_default_output_device_info()
-      config.MIC_RATE = int(wasapi["defaultSampleRate"])
-      stream = p.open(format=pyaudio.paInt16,
-                    channels=wasapi["maxOutputChannels"],
+    info, n_channels = _input_device(p)
+    config.MIC_RATE = int(info['defaultSampleRate'])
+    ring = CaptureRing(n_channels, int(config.MIC_RATE * CAPTURE_SECONDS))
+
+    def stream_callback(in_data, frame_count, time_info, status):
+        if status & pyaudio.paInputOverflow:
+            ring.overflows += 1
+        ring.write(in_data)
+        callback(ring)
+        return None, pyaudio.paContinue
+
+    options = {'as_loopback': True} if config.AUDIO_DEVICE is None and config.AUDIO_SOURCE == 'loopback' else {}
+    stream = p.open(format=pyaudio.paInt16,
+                    channels=n_channels,
                     rate=config.MIC_RATE,
                     input=True,
-                    input_device_index = wasapi["index"],
+                    input_device_index=info['index'],
                     frames_per_buffer=frames_per_buffer,
-                    as_loopback = True)
-    elif config.AUDIO_SOURCE == 'mic':
-      wasapi = p.get_default_input_device_info()
-      config.MIC_RATE = int(wasapi["defaultSampleRate"])
-      stream = p.open(format=pyaudio.paInt16,
-                    channels=wasapi["maxInputChannels"],
-                    rate=config.MIC_RATE,
-                    input=True,
-                    input_device_index = wasapi["index"],
-                    frames_per_buffer=frames_per_buffer)
-    
-    overflows = 0
-    prev_ovf_time = time.time()
-    while True:
-        try:
-		    # http://stackoverflow.com/questions/22636499/convert-multi-channel-pyaudio-into-numpy-array
-            y = np.fromstring(stream.read(frames_per_buffer), dtype=np.int16)
-            if config.AUDIO_SOURCE == 'loopback':
-              y = np.reshape(y, (frames_per_buffer, wasapi["maxOutputChannels"]))
-            elif config.AUDIO_SOURCE == 'mic':
-              y = np.reshape(y, (frames_per_buffer, wasapi["maxInputChannels"]))
-            y = y.astype(np.float32)
-            callback(y[:, 0])
-        except IOError:
-            overflows += 1
-            if time.time() > prev_ovf_time + 1:
-                prev_ovf_time = time.time()
-                print('Audio buffer has overflowed {} times'.format(overflows))
+                    stream_callback=stream_callback,
+                    **options)
+    stream_opened.set()
+    overflows = skipped = 0
+    while stream.is_active():
+        time.sleep(1.0)
+        if ring.overflows > overflows:
+            overflows = ring.overflows
+            print('Audio buffer has overflowed {} times'.format(overflows))
+        if ring.skipped > skipped:
+            skipped = ring.skipped
+            print('Skipped {} stale audio frames'.format(skipped))
     stream.stop_stream()
     stream.close()
     p.terminate()
@@ -0,0 +1,196 @@
+"""Threaded capture -> analysis -> output pipeline
+
+Every stage runs on its own thread and stages are joined by bounded queues,
+so a slow stage (for example a LIFX or Chroma call in the output stage) can
+never stall audio capture. When a queue is full the configured backpressure
+policy decides which frames are thrown away.
+
+A stage can also be a ScheduledStage that is driven by a clock instead of
+its queue. It runs on fixed deadlines at the configured frame rate and processes
+whatever has arrived since its previous deadline, independent of the block
+size chosen by the sound driver.
+"""
+from __future__ import print_function
+from __future__ import division
+import collections
+import threading
+import time
+import config
+import metrics
+
+DROP_OLDEST = 'drop_oldest'
+"""Discard the oldest queued frame to make room for the new one"""
+
+KEEP_LATEST = 'keep_latest'
+"""Discard every queued frame so that only the newest one is kept"""
+
+_SCHEDULED_QUEUE_SIZE = 64
+"""Blocks buffered for a scheduled stage, enough for small driver block sizes"""
+
+
+class FrameQueue:
+    """Bounded queue that never blocks the producer"""
+    def __init__(self, maxsize=None, policy=None):
+        self.maxsize = config.PIPELINE_QUEUE_SIZE if maxsize is None else maxsize
+        self.policy = config.PIPELINE_BACKPRESSURE if policy is None else policy
+        assert self.maxsize > 0, 'Queue size must be positive'
+        assert self.policy in (DROP_OLDEST, KEEP_LATEST), \
+            'Invalid backpressure policy: {}'.format(self.policy)
+        self.dropped = 0
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        """Adds an item, discarding queued items if the queue is full"""
+        with self._cond:
+            if self.policy == KEEP_LATEST:
+                self.dropped += len(self._items)
+                self._items.clear()
+            elif len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Removes and returns the oldest item, or None after a timeout"""
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def drain(self):
+        """Removes and returns every queued item without waiting"""
+        with self._cond:
+            items = list(self._items)
+            self._items.clear()
+            return items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class Stage(threading.Thread):
+    """Pipeline stage that applies a function to every item of its queue
+
+    The return value of the function is passed on to the output queue,
+    unless it is None.
+    """
+    def __init__(self, name, function, inputs, outputs=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.function = function
+        self.inputs = inputs
+        self.outputs = outputs
+        self.processed = 0
+        self._running = threading.Event()
+
+    def run(self):
+        self._running.set()
+        while self._running.is_set():
+            item = self.inputs.get(timeout=0.1)
+            if item is None:
+                continue
+            result = self.function(item)
+            self.processed += 1
+            if result is not None and self.outputs is not None:
+                self.outputs.put(result)
+
+    def stop(self):
+        self._running.clear()
+
+
+class ScheduledStage(Stage):
+    """Pipeline stage that runs on monotonic clock deadlines
+
+    At every deadline the function is called with the list of all items that
+    arrived since the previous deadline, which may be empty. Deadlines that
+    have already passed are skipped rather than processed late, and counted
+    in missed_deadlines.
+    """
+    def __init__(self, name, function, inputs, outputs=None, fps=None):
+        Stage.__init__(self, name, function, inputs, outputs)
+        self.period = 1.0 / (config.FPS if fps is None else fps)
+        self.missed_deadlines = 0
+
+    def run(self):
+        self._running.set()
+        deadline = metrics.monotonic() + self.period
+        while self._running.is_set():
+            delay = deadline - metrics.monotonic()
+            if delay > 0.0:
+                time.sleep(delay)
+            else:
+                missed = int(-delay // self.period)
+                self.missed_deadlines += missed
+                deadline += missed * self.period
+            deadline += self.period
+            result = self.function(self.inputs.drain())
+            self.processed += 1
+            if result is not None and self.outputs is not None:
+                self.outputs.put(result)
+
+
+class Pipeline:
+    """Chain of stages connected by bounded queues
+
+    The first stage is a source: a function that takes a callback and calls
+    it for every captured item, such as microphone.start_stream. Each
+    following stage transforms the items produced by the previous one.
+    Stages are (name, function) pairs, or (name, function, fps) triples
+    for stages that run on deadlines (see ScheduledStage).
+    """
+    def __init__(self, source, stages):
+        self.queues = []
+        self.stages = []
+        inputs = FrameQueue()
+        self.queues.append(('capture', inputs))
+        self._source = threading.Thread(target=source, args=(inputs.put,),
+                                        name='capture')
+        self._source.daemon = True
+        for i, stage in enumerate(stages):
+            name, function = stage[:2]
+            outputs = FrameQueue() if i < len(stages) - 1 else None
+            if len(stage) > 2:
+                inputs.maxsize = max(inputs.maxsize, _SCHEDULED_QUEUE_SIZE)
+                self.stages.append(ScheduledStage(name, function, inputs,
+                                                  outputs, stage[2]))
+            else:
+                self.stages.append(Stage(name, function, inputs, outputs))
+            if outputs is not None:
+                self.queues.append((name, outputs))
+            inputs = outputs
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        self._source.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            stage.join()
+
+    def join(self):
+        """Blocks until the capture thread exits"""
+        while self._source.is_alive():
+            self._source.join(0.5)
+
+    def capturing(self):
+        """Returns whether the capture thread is still running"""
+        return self._source.is_alive()
+
+    def missed_deadlines(self):
+        """Returns the total number of deadlines missed by scheduled stages"""
+        return sum(getattr(stage, 'missed_deadlines', 0) for stage in self.stages)
+
+    def frames(self):
+        """Returns the number of items processed by the last stage"""
+        return self.stages[-1].processed if self.stages else 0
+
+    def queue_depths(self):
+        """Returns (stage name, queue depth, dropped frames) for every queue"""
+        return [(name, len(q), q.dropped) for name, q in self.queues]
@@ -0,0 +1,207 @@
+"""Fan-out of LED frames to any number of ESP8266 receivers
+
+Every receiver displays its own range or selection of pixels, keeps its own
+record of the last frame it was sent and can use its own socket options.
+All packets for a frame are sent in one batch, using the sendmmsg system
+call where it is available.
+"""
+from __future__ import print_function
+from __future__ import division
+import ctypes
+import ctypes.util
+import socket
+import struct
+import numpy as np
+import config
+import codec
+import metrics
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """Returns libc's sendmmsg function, or None if it is not available"""
+    name = ctypes.util.find_library('c')
+    if name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                         ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+_sendmmsg = _load_sendmmsg()
+"""Batched send system call (Linux only)"""
+
+
+def _sockaddr_in(ip, port):
+    """Returns a struct sockaddr_in for an IPv4 address"""
+    sockaddr = struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) \
+        + socket.inet_aton(ip) + b'\0' * 8
+    return ctypes.create_string_buffer(sockaddr, len(sockaddr))
+
+
+def send_batch(sock, messages):
+    """Sends a list of (packet, receiver) pairs through one socket
+
+    Uses a single sendmmsg call where available and falls back to one
+    sendto call per packet otherwise. Packets that cannot be sent are
+    dropped, like any other lost UDP packet. Returns the number sent.
+    """
+    n = len(messages)
+    if _sendmmsg is None or n == 1:
+        sent = 0
+        for packet, receiver in messages:
+            try:
+                sock.sendto(packet, receiver.address)
+                sent += 1
+            except socket.error:
+                pass
+        return sent
+    buffers = [ctypes.c_char_p(packet) for packet, _ in messages]
+    iovecs = (_iovec * n)()
+    msgs = (_mmsghdr * n)()
+    for i, (packet, receiver) in enumerate(messages):
+        iovecs[i].iov_base = ctypes.cast(buffers[i], ctypes.c_void_p)
+        iovecs[i].iov_len = len(packet)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.cast(receiver.sockaddr, ctypes.c_void_p)
+        hdr.msg_namelen = len(receiver.sockaddr)
+        hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdr.msg_iovlen = 1
+    fd = sock.fileno()
+    sent = 0
+    i = 0
+    while i < n:
+        ret = _sendmmsg(fd, ctypes.addressof(msgs) + i * ctypes.sizeof(_mmsghdr),
+                        n - i, 0)
+        if ret <= 0:
+            # Skip the packet that failed and carry on with the rest
+            i += 1
+        else:
+            i += ret
+            sent += ret
+    return sent
+
+
+class Receiver:
+    """One ESP8266 and the part of the LED strip that it displays"""
+    def __init__(self, ip, port=None, pixels=None, protocol=None,
+                 keyframe_interval=None, sndbuf=None, tos=None):
+        """
+        Parameters
+        ----------
+        ip : str
+            IP address of the ESP8266.
+        port : int, optional
+            UDP port of the ESP8266. Default: config.UDP_PORT
+        pixels : tuple or list, optional
+            (start, stop) range or list of indices of the strip pixels shown
+            by this receiver, in order. Default: every pixel.
+        protocol : int, optional
+            Packet format understood by the firmware.
+            Default: config.ESP8266_PROTOCOL
+        keyframe_interval : float, optional
+            Seconds between complete frames, which repair pixels that were
+            lost with a dropped packet. Default: config.UDP_KEYFRAME_INTERVAL
+        sndbuf, tos : int, optional
+            SO_SNDBUF and IP_TOS socket options for this receiver.
+        """
+        self.ip = ip
+        self.port = config.UDP_PORT if port is None else port
+        self.address = (ip, self.port)
+        self.sockaddr = _sockaddr_in(ip, self.port)
+        if pixels is None:
+            pixels = (0, config.N_PIXELS)
+        if isinstance(pixels, tuple):
+            pixels = np.arange(*pixels)
+        self.pixels = np.asarray(pixels, dtype=int)
+        self.protocol = config.ESP8266_PROTOCOL if protocol is None else protocol
+        assert self.protocol != 1 or len(self.pixels) <= 256, \
+            'Protocol 1 supports at most 256 pixels per receiver'
+        self.codec = codec.FrameCodec(self.protocol)
+        if keyframe_interval is None:
+            keyframe_interval = config.UDP_KEYFRAME_INTERVAL
+        self.keyframe_interval = keyframe_interval
+        self.next_keyframe = metrics.monotonic()
+        self.socket_options = (sndbuf, tos)
+
+    def encode(self, p, now):
+        """Returns the packets that update this receiver to show p"""
+        if self.keyframe_interval and now >= self.next_keyframe:
+            self.next_keyframe = now + self.keyframe_interval
+            self.codec.reset()
+        return self.codec.encode(p)
+
+
+class ReceiverGroup:
+    """Sends every frame to a list of receivers"""
+    def __init__(self, receivers):
+        """Creates the receivers from a list of Receiver keyword dictionaries"""
+        self.receivers = [Receiver(**r) for r in receivers]
+        # Spread the keyframes so that they do not all land on the same frame
+        now = metrics.monotonic()
+        for i, receiver in enumerate(self.receivers):
+            if receiver.keyframe_interval:
+                receiver.next_keyframe = now + receiver.keyframe_interval \
+                    * (i + 1) / len(self.receivers)
+        # All pixel mappings concatenated, so one gather serves every receiver
+        self._index = np.concatenate([r.pixels for r in self.receivers])
+        bounds = np.cumsum([0] + [len(r.pixels) for r in self.receivers])
+        for i, receiver in enumerate(self.receivers):
+            receiver.span = slice(bounds[i], bounds[i + 1])
+        # Receivers with the same socket options share a socket
+        self._sockets = {}
+        self._groups = {}
+        for receiver in self.receivers:
+            options = receiver.socket_options
+            if options not in self._sockets:
+                self._sockets[options] = self._open_socket(*options)
+                self._groups[options] = []
+            self._groups[options].append(receiver)
+
+    @staticmethod
+    def _open_socket(sndbuf, tos):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        if tos is not None:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, tos)
+        return sock
+
+    def send(self, p):
+        """Sends the (3, N) gamma corrected frame p to every receiver"""
+        mapped = p[:, self._index]
+        now = metrics.monotonic()
+        for options, group in self._groups.items():
+            with metrics.timed('encode'):
+                messages = [(m, r) for r in group
+                            for m in r.encode(mapped[:, r.span], now)]
+            if messages:
+                send_batch(self._sockets[options], messages)
+
+    def bytes_per_frame(self):
+        """Returns the mean number of bytes sent per frame to all receivers"""
+        return sum(r.codec.bytes_per_frame() for r in self.receivers)
@@ -0,0 +1,124 @@
+"""Recording and replay of LED pixel frames
+
+A recording is a small fixed-size header followed by fixed-size frame
+records, so the frames of a recording can be memory-mapped as one NumPy
+array and replayed without any audio capture or signal processing.
+
+Header (32 bytes, little-endian):
+    magic (8 bytes), version (uint32), n_pixels (uint32), fps (float64),
+    8 reserved bytes
+Frame record (8 + 3 * n_pixels bytes):
+    time (float64, seconds since the first frame), rgb (3 x n_pixels uint8)
+
+Usage:
+    python recording.py show.rec [--loop]
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+import time
+import numpy as np
+import config
+import metrics
+
+MAGIC = b'LEDREC\r\n'
+VERSION = 1
+
+HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('n_pixels', '<u4'),
+                   ('fps', '<f8'), ('reserved', 'V8')])
+"""Layout of the recording header"""
+
+def frame_dtype(n_pixels):
+    """Returns the layout of one frame record"""
+    return np.dtype([('time', '<f8'), ('rgb', 'u1', (3, n_pixels))])
+
+
+class Recorder:
+    """Appends pixel frames to a recording file"""
+    def __init__(self, path, n_pixels=None, fps=None):
+        self.n_pixels = config.N_PIXELS if n_pixels is None else n_pixels
+        self.fps = config.FPS if fps is None else fps
+        self._file = open(path, 'wb')
+        header = np.zeros(1, dtype=HEADER)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['n_pixels'] = self.n_pixels
+        header['fps'] = self.fps
+        self._file.write(header.tobytes())
+        self._record = np.zeros(1, dtype=frame_dtype(self.n_pixels))
+        self._start = None
+
+    def write(self, pixels, t=None):
+        """Appends a (3, n_pixels) frame, by default timestamped with the current time"""
+        if t is None:
+            now = metrics.monotonic()
+            if self._start is None:
+                self._start = now
+            t = now - self._start
+        self._record['time'] = t
+        np.clip(pixels, 0, 255, out=self._record['rgb'][0], casting='unsafe')
+        self._file.write(self._record.tobytes())
+
+    def close(self):
+        self._file.close()
+
+
+def save(path, frames, fps=None):
+    """Writes a (n_frames, 3, n_pixels) array as a recording at a fixed frame rate"""
+    fps = config.FPS if fps is None else fps
+    recorder = Recorder(path, n_pixels=frames.shape[2], fps=fps)
+    for i, frame in enumerate(frames):
+        recorder.write(frame, t=i / float(fps))
+    recorder.close()
+
+
+def load(path):
+    """Returns the header and memory-mapped frame records of a recording
+
+    The records have a 'time' field with the frame timestamps and an 'rgb'
+    field with the (3, n_pixels) uint8 frames. An incomplete last record,
+    left by a recording that was interrupted, is ignored.
+    """
+    header = np.fromfile(path, dtype=HEADER, count=1)
+    if len(header) == 0 or header['magic'][0] != MAGIC:
+        raise ValueError('{} is not a pixel recording'.format(path))
+    if header['version'][0] != VERSION:
+        raise ValueError('Unsupported recording version {}'.format(header['version'][0]))
+    header = header[0]
+    dtype = frame_dtype(int(header['n_pixels']))
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        n_frames = (f.tell() - HEADER.itemsize) // dtype.itemsize
+    if n_frames == 0:
+        return header, np.zeros(0, dtype=dtype)
+    frames = np.memmap(path, dtype=dtype, mode='r', offset=HEADER.itemsize,
+                       shape=(n_frames,))
+    return header, frames
+
+
+def replay(path, loop=False):
+    """Streams a recording to the configured LED devices at its recorded timing"""
+    import led
+    header, frames = load(path)
+    assert int(header['n_pixels']) == config.N_PIXELS, \
+        'Recording has {} pixels but N_PIXELS is {}'.format(header['n_pixels'], config.N_PIXELS)
+    while True:
+        start = metrics.monotonic()
+        if len(frames):
+            start -= frames['time'][0]
+        for frame in frames:
+            delay = start + frame['time'] - metrics.monotonic()
+            if delay > 0.0:
+                time.sleep(delay)
+            led.pixels = frame['rgb']
+            led.update()
+        if not loop:
+            break
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a pixel recording on the LED strip')
+    parser.add_argument('recording', help='Recording file to replay')
+    parser.add_argument('--loop', action='store_true', help='Replay forever')
+    args = parser.parse_args()
+    replay(args.recording, loop=args.loop)
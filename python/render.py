@@ -0,0 +1,104 @@
+"""Offline renderer: reads an audio file and writes the resulting LED frames
+
+No sound card, GUI or LED strip is needed. The spectrum and mel filterbank
+output of the whole recording are computed in large vectorized batches,
+after which the selected effect runs over every frame. The result is saved
+as a (n_frames, 3, N_PIXELS) uint8 array with numpy.save, or as a pixel
+recording (see recording.py) if the output file name ends with .rec.
+
+Usage:
+    python render.py song.wav frames.npy --effect scroll
+    python render.py song.wav show.rec
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+import time
+import numpy as np
+from scipy.io import wavfile
+import config
+import dsp
+import analysis
+import effects
+import recording
+
+_BATCH_FRAMES = 1024
+"""Number of frames transformed together, which bounds the memory used"""
+
+
+def read_audio(path):
+    """Returns the sample rate and the config.AUDIO_CHANNELS samples of a WAV file
+
+    Samples are scaled to the 16-bit integer range used by the microphone.
+    Stereo samples are (2, n) rows.
+    """
+    rate, samples = wavfile.read(path)
+    if samples.dtype == np.uint8:
+        samples = (samples.astype(np.float32) - 128.0) * 256.0
+    elif samples.dtype == np.int32:
+        samples = samples / 2.0**16
+    elif samples.dtype.kind == 'f':
+        samples = samples * 2.0**15
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    return rate, dsp.downmix(samples, config.AUDIO_CHANNELS)
+
+
+def render(samples, effect):
+    """Returns the LED frames of a visualization effect for a recording
+
+    Parameters
+    ----------
+    samples : ndarray
+        Mono audio samples in the 16-bit integer range at config.MIC_RATE,
+        or (2, n) stereo samples.
+    effect : callable
+        Visualization effect such as effects.Spectrum(), or an
+        effects.Stereo effect for stereo samples.
+    """
+    hop = int(config.MIC_RATE / config.FPS)
+    frames = dsp.rolling_windows(samples / 2.0**15, hop,
+                                 hop * config.N_ROLLING_HISTORY)
+    n_frames = frames.shape[-2]
+    output = np.zeros((n_frames, 3, config.N_PIXELS), dtype=np.uint8)
+    extractor = analysis.FeatureExtractor(samples.shape[0] if samples.ndim > 1 else None)
+    features = analysis.Features(samples.shape[0] if samples.ndim > 1 else None)
+    for start in range(0, n_frames, _BATCH_FRAMES):
+        batch = frames[..., start:start + _BATCH_FRAMES, :]
+        mel = dsp.mel_bank.project(dsp.batch_spectrum(batch))
+        # Loudest channel of every frame
+        peak = np.max(np.abs(batch), axis=-1)
+        loud = peak.reshape(-1, peak.shape[-1]).max(axis=0) >= config.MIN_VOLUME_THRESHOLD
+        for i in np.flatnonzero(loud):
+            extractor.extract(analysis.scale_mel(mel[..., i, :]), batch[..., i, :], out=features)
+            pixels = effect(features)
+            output[start + i] = np.clip(pixels, 0, 255)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render LED frames from an audio file')
+    parser.add_argument('audio', help='WAV file to visualize')
+    parser.add_argument('output', help='.npy or .rec file to write the frames to')
+    parser.add_argument('--effect', default='spectrum',
+                        choices=sorted(effects.EFFECTS))
+    args = parser.parse_args()
+    rate, samples = read_audio(args.audio)
+    # The mel filterbank must be built for the file's sample rate
+    config.MIC_RATE = rate
+    dsp.create_mel_bank()
+    effect = effects.create(args.effect)
+    start = time.time()
+    output = render(samples, effect)
+    elapsed = time.time() - start
+    if args.output.endswith('.rec'):
+        recording.save(args.output, output)
+    else:
+        np.save(args.output, output)
+    duration = samples.shape[-1] / float(rate)
+    print('Rendered {} frames ({:.1f} s of audio) in {:.1f} s, {:.0f}x real time'.format(
+        len(output), duration, elapsed, duration / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Output devices (sinks) that display the LED frames
+
+Every backend lives in its own module and is only imported and initialized
+when it is enabled in config.py. Libraries of unused devices are therefore
+never needed, and slow initialization such as LIFX discovery happens in
+parallel with the other backends instead of as an import side effect.
+
+A backend module provides create(), which returns a Sink.
+"""
+from __future__ import print_function
+from __future__ import division
+import importlib
+import threading
+import time
+import config
+
+BACKENDS = {
+    'esp8266': 'sinks.esp8266',
+    'pi': 'sinks.pi',
+    'blinkstick': 'sinks.blinkstick',
+    'chroma': 'sinks.chroma',
+    'lifx': 'sinks.lifx',
+}
+"""Modules of the backends by name"""
+
+
+class Sink:
+    """Output device that displays LED frames"""
+    rate = None
+    """Maximum number of frames per second, or None for no limit"""
+
+    def update(self, pixels, features=None):
+        """Displays a (3, N_PIXELS) frame of pixel values between 0 and 255
+
+        features are the analysis.Features of the frame, or None when there
+        is no audio, for devices that react to the audio directly.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Switches the device off"""
+        pass
+
+
+def enabled():
+    """Returns the names of the backends enabled in config.py"""
+    names = [config.DEVICE]
+    # The additional devices follow the ESP8266 strip only
+    if config.DEVICE == 'esp8266':
+        if config.DEVICES_ENABLED['CHROMA']:
+            names.append('chroma')
+        if config.DEVICES_ENABLED['LIFX']:
+            names.append('lifx')
+    return names
+
+
+def create(name):
+    """Imports and initializes a backend, returns its sink"""
+    if name not in BACKENDS:
+        raise ValueError('Invalid device selected: {}'.format(name))
+    return importlib.import_module(BACKENDS[name]).create()
+
+
+def open_all(names=None):
+    """Initializes backends in parallel
+
+    Returns
+    -------
+    sinks : list
+        (name, sink) pairs of the backends that started, in order of names.
+    startup : list
+        (name, seconds, error) for every backend, where error is the
+        exception raised by a backend that failed to start, or None.
+    """
+    names = enabled() if names is None else names
+    results = {}
+
+    def start(name):
+        begin = time.time()
+        try:
+            sink, error = create(name), None
+        except Exception as e:
+            sink, error = None, e
+        results[name] = (sink, time.time() - begin, error)
+
+    threads = [threading.Thread(target=start, args=(name,), name=name)
+               for name in names]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sinks = [(name, results[name][0]) for name in names if results[name][0] is not None]
+    startup = [(name,) + results[name][1:] for name in names]
+    return sinks, startup
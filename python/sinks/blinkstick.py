@@ -0,0 +1,35 @@
+"""LED strip connected to a BlinkstickPro"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import  # blinkstick is also the name of this module
+from blinkstick import blinkstick
+import config
+from sinks import Sink
+from sinks import encoding
+
+
+class Blinkstick(Sink):
+    """Writes new LED values to the Blinkstick
+
+    Frames that did not change are not sent again.
+    """
+    def __init__(self):
+        # blinkstick uses GRB format
+        self.encoder = encoding.for_sink('blinkstick', order='grb')
+        self.stick = blinkstick.find_first()
+
+    def update(self, pixels, features=None):
+        self.encoder.encode(pixels)
+        if len(self.encoder.changed()) == 0:
+            return
+        #send the data to the blinkstick
+        self.stick.set_led_data(0, self.encoder.interleaved().tolist())
+
+    def close(self):
+        # Turn all leds off
+        all_off = [0]*(config.N_PIXELS*3)
+        self.stick.set_led_data(0, all_off)
+
+
+def create():
+    return Blinkstick()
@@ -0,0 +1,213 @@
+"""Razer Chroma keyboards, keypads, mice, mousepads and headsets
+
+The mapping from the LED strip to the keys and LEDs of every device is
+compiled once into a matrix, so a frame is mapped onto every device with a
+single product. The colors of every device are kept in NumPy buffers, the
+scrolling keyboard and keypad history in a ring of rows. Only cells whose
+color changed are written to the ChromaColor objects, and only devices with
+changes are sent to the Chroma SDK.
+"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+from ChromaPython import ChromaApp, ChromaAppInfo, ChromaColor, Colors
+import config
+from sinks import Sink
+from sinks import encoding
+
+
+def _pick(n_pixels, indices):
+    """Returns a matrix that selects the given pixels of the strip"""
+    weights = np.zeros((len(indices), n_pixels))
+    weights[np.arange(len(indices)), indices] = 1.0
+    return weights
+
+
+def _segments(n_pixels, n):
+    """Returns a matrix that averages n equal segments of the strip"""
+    weights = np.zeros((n, n_pixels))
+    for i, segment in enumerate(np.array_split(np.arange(n_pixels), n)):
+        weights[i, segment] = 1.0 / len(segment)
+    return weights
+
+
+class _Layout:
+    """Mapping of the LED strip onto the cells of every device
+
+    targets maps a device name to its cells: column indices of the top row
+    of the keyboard and keypad, LED indices of the mousepad, (x, y)
+    positions of the mouse and one color for the headset.
+    """
+    def __init__(self, mappings):
+        self.targets = {}
+        self.rows = {}
+        weights = []
+        start = 0
+        for name, targets, w in mappings:
+            self.targets[name] = targets
+            self.rows[name] = slice(start, start + len(w))
+            weights.append(w)
+            start += len(w)
+        self.weights = np.concatenate(weights)
+
+    def colors(self, pixels):
+        """Returns the (cells, 3) colors of every cell of every device"""
+        colors = np.dot(self.weights, np.transpose(pixels))
+        return np.clip(colors, 0, 255).astype(np.uint8)
+
+
+class _Grid:
+    """Custom color grid of a device, optionally scrolling one row per frame
+
+    The rows of NumPy colors and the rows of ChromaColor objects are both
+    kept in a ring, so scrolling only reorders the rows and only the cells
+    of the newest row are ever written.
+    """
+    def __init__(self, device, rows, columns, scroll):
+        self.device = device
+        self.scroll = scroll
+        self.history = np.zeros((rows, columns, 3), dtype=np.uint8)
+        """Ring of the most recent rows, the newest one at self.head"""
+        self.colors = [[ChromaColor(red=0, green=0, blue=0) for x in range(columns)]
+                       for y in range(rows)]
+        """ChromaColor objects of the rows in self.history"""
+        self.head = 0
+        self._order = [(head - np.arange(rows)) % rows for head in range(rows)]
+        self._row = np.zeros((columns, 3), dtype=np.uint8)
+        self._frame = np.zeros_like(self.history)
+        self.shown = np.zeros_like(self.history)
+        """Colors that were last sent to the device"""
+
+    def update(self, cells, colors):
+        """Shows colors in the given cells of the top row
+
+        Returns whether the device has to be updated.
+        """
+        if self.scroll:
+            # The oldest row becomes the newest
+            self.head = (self.head + 1) % len(self.history)
+        row = self._row
+        row[:] = 0
+        row[cells] = colors
+        slot = self.history[self.head]
+        for x in np.flatnonzero(np.any(row != slot, axis=-1)).tolist():
+            r, g, b = row[x].tolist()
+            self.colors[self.head][x].set(red=r, green=g, blue=b)
+        slot[:] = row
+        frame = np.take(self.history, self._order[self.head], axis=0, out=self._frame)
+        if np.array_equal(frame, self.shown):
+            return False
+        self.shown[:] = frame
+        return True
+
+    @property
+    def grid(self):
+        """Rows of ChromaColor objects, newest first"""
+        return [self.colors[i] for i in self._order[self.head]]
+
+
+class Chroma(Sink):
+    """Shows the LED strip on the Chroma devices"""
+    def __init__(self):
+        self.rate = config.CHROMA_FPS
+        Info = ChromaAppInfo
+        Info.DeveloperName = 'd-rez'
+        Info.DeveloperContact = 'dark.skeleton@gmail.com'
+        Info.Category = 'application'
+        Info.SupportedDevices = ['keyboard', 'mouse', 'mousepad', 'headset', 'keypad']
+        Info.Description = 'Oh Rick, I don\'t know if that\'s a good idea.'
+        Info.Title = 'Audio Reactive Chroma-extended LED strip'
+        self.App = App = ChromaApp(Info)
+        # The devices apply their own gamma correction
+        self.encoder = encoding.for_sink('chroma', gamma=False, dither=False)
+
+        self._keyboard = _Grid(App.Keyboard, App.Keyboard.MaxRow, App.Keyboard.MaxColumn, True)
+        self._keypad = _Grid(App.Keypad, App.Keypad.MaxRow, App.Keypad.MaxColumn, True)
+        self._mousepad = _Grid(App.Mousepad, 1, App.Mousepad.MaxLED, False)
+        self._mouse = {}
+        """Colors last sent to every (x, y) position of the mouse"""
+        self._headset = None
+        self._layouts = {False: self._layout_v2(), True: self._layout_scaled()}
+
+    def _layout_v2(self):
+        """
+        Chroma at full resolution without any rescaling.
+        Every device will display different section of the LED strip's spectrum
+        This is my new implementation but it doesn't have the side-strips working on mice that have it (yet)
+        """
+        App = self.App
+        n = config.N_PIXELS
+        if config.CHROMA_TKL_KEYBOARD:
+          keyboard_columns = App.Keyboard.MaxColumn - 6 # This will "center" the effect better on laptops and TKLs
+        else:
+          keyboard_columns = App.Keyboard.MaxColumn
+
+        # Some calculations for array limits
+        keyb_l = int(config.N_PIXELS/2-keyboard_columns/2)
+        keyb_r = keyb_l + keyboard_columns
+        keyp_r = keyb_l - 1
+        keyp_l = keyp_r - App.Keypad.MaxColumn
+        mpad_l = keyb_r + 1
+        mpad_r = mpad_l + App.Mousepad.MaxLED
+        return _Layout([
+            ('keyboard', np.arange(keyboard_columns), _pick(n, np.arange(keyb_l, keyb_r))),
+            ('keypad', np.arange(App.Keypad.MaxColumn), _pick(n, np.arange(keyp_l, keyp_r))),
+            ('mousepad', np.arange(App.Mousepad.MaxLED)[::-1], _pick(n, np.arange(mpad_l, mpad_r))),
+            ('mouse', [(3, 2), (3, 7)], _pick(n, [mpad_l, mpad_l + 1])),
+            ('headset', None, _pick(n, [mpad_l]))])
+
+    def _layout_scaled(self):
+        """
+        Chroma at scaled resolution.
+        Every device will display the exact same section of the LED strip's spectrum, scaled down to each device's size
+        This is my old implementation, but it has the side-strips working on mice that have it
+        """
+        n = config.N_PIXELS
+        mid = 7
+        segments15 = _segments(n, 15)
+        # rescale to 20 for TKL keyboard and to 5 for keypads
+        segments20 = _segments(n, 20)
+        segments5 = np.dot(_segments(20, 5), segments20)
+        mouse = [(0, i + 1) for i in range(0, 7)] + [(6, 7 - (i - 7) + 1) for i in range(7, 15)]
+        return _Layout([
+            ('keyboard', np.arange(16), segments20[2:18]),
+            ('keypad', np.arange(5), segments5),
+            ('mousepad', np.arange(15), segments15),
+            ('mouse', mouse + [(3, 2)], np.concatenate((segments15, segments15[mid:mid + 1]))),
+            ('headset', None, segments15[mid:mid + 1])])
+
+    def update(self, pixels, features=None):
+        layout = self._layouts[bool(config.CHROMA_VISTYPE_SCALED)]
+        colors = layout.colors(self.encoder.encode(pixels))
+        for name, grid in (('keyboard', self._keyboard), ('keypad', self._keypad),
+                           ('mousepad', self._mousepad)):
+            if grid.update(layout.targets[name], colors[layout.rows[name]]):
+                grid.device.setCustomGrid(grid.colors[0] if name == 'mousepad' else grid.grid)
+                grid.device.applyGrid()
+        # Mouse
+        changed = False
+        for position, color in zip(layout.targets['mouse'], colors[layout.rows['mouse']].tolist()):
+            if self._mouse.get(position) != color:
+                self._mouse[position] = color
+                x, y = position
+                self.App.Mouse.setPosition(x=x, y=y, color=ChromaColor(red=color[0], green=color[1], blue=color[2]))
+                changed = True
+        if changed:
+            self.App.Mouse.applyGrid()
+        # Headset
+        color = colors[layout.rows['headset']][0].tolist()
+        if color != self._headset:
+            self._headset = color
+            self.App.Headset.setNone()
+            self.App.Headset.setStatic(color=ChromaColor(red=color[0], green=color[1], blue=color[2]))
+
+    def close(self):
+        self.App.Keyboard.setNone()
+        self.App.Keypad.setNone()
+        self.App.Mouse.setNone()
+        self.App.Mousepad.setNone()
+        self.App.Headset.setNone()
+
+
+def create():
+    return Chroma()
@@ -0,0 +1,166 @@
+"""Conversion of pixel frames into the byte layouts of LED strip drivers
+
+Gamma correction, the brightness limit and the white balance of an output
+device are compiled into one lookup table with 256 entries per channel, so a
+frame is converted with a single gather on uint8 values. Every other step
+works on whole preallocated arrays too: clipping, optional temporal
+dithering, channel reordering, packing into 24-bit integers and detecting
+which pixels changed since the previous frame. Backends only have to copy
+the result into their driver, and can skip pixels that did not change.
+"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import config
+
+
+def _smooth(table):
+    """Returns a continuous curve through the steps of an integer table
+
+    The curve passes halfway between two values where the table steps from
+    one to the next, so it rounds to the table while the fractions in
+    between can still be shown by dithering.
+    """
+    steps = np.flatnonzero(np.diff(table)) + 1
+    x = np.concatenate(([0.0], steps - 0.5, [len(table) - 1.0]))
+    y = np.concatenate(([table[0]], (table[steps - 1] + table[steps]) / 2.0, [table[-1]]))
+    return np.interp(np.arange(len(table)), x, y)
+
+
+def compile_lut(gamma=True, brightness=1.0, white_balance=(1.0, 1.0, 1.0), dither=False):
+    """Returns the (3, 256) lookup table of an output device
+
+    Without dithering every entry is the uint8 output value. With dithering
+    every entry is a little-endian uint16 with the output value in the high
+    byte and the fraction that the dithering adds over time in the low byte.
+    """
+    table = np.arange(256.0)
+    if gamma:
+        table = np.load(config.GAMMA_TABLE_PATH).astype(float)
+        if dither:
+            table = _smooth(table)
+    scale = brightness * np.asarray(white_balance, dtype=float)
+    values = np.clip(table * scale[:, np.newaxis], 0.0, 255.0)
+    if not dither:
+        return np.rint(values).astype(np.uint8)
+    return np.rint(values * 256.0).astype('<u2')
+
+
+class PixelEncoder:
+    """Encodes (3, n_pixels) frames for a LED strip driver
+
+    Parameters
+    ----------
+    n_pixels : int
+        Number of pixels in the frames.
+    order : str
+        Order of the color channels expected by the driver, such as 'rgb'
+        or 'grb'.
+    gamma : bool
+        Whether to apply the gamma table. Default: SOFTWARE_GAMMA_CORRECTION.
+    brightness : float
+        Maximum brightness between 0.0 and 1.0.
+    white_balance : tuple
+        Red, green and blue gains between 0.0 and 1.0.
+    dither : bool
+        Whether to show the fractions of the output values by temporal
+        dithering, which keeps fades smooth at low brightness.
+    """
+    def __init__(self, n_pixels=None, order='rgb', gamma=None, brightness=1.0,
+                 white_balance=(1.0, 1.0, 1.0), dither=False):
+        self.n_pixels = n = config.N_PIXELS if n_pixels is None else n_pixels
+        gamma = config.SOFTWARE_GAMMA_CORRECTION if gamma is None else gamma
+        assert sorted(order) == ['b', 'g', 'r'], 'Invalid channel order: {}'.format(order)
+        self.order = ['rgb'.index(c) for c in order]
+        # One row per channel, flattened for a single gather
+        self.lut = compile_lut(gamma, brightness, white_balance, dither).ravel()
+        self.dither = dither
+        # Bounds of the rows of every channel in the flattened table
+        self._lowest = np.repeat(np.arange(0.0, 3 * 256, 256), n).reshape(3, n)
+        self._highest = self._lowest + 255
+        self._clipped = np.zeros((3, n))
+        self._index = np.zeros((3, n), dtype=np.uint16)
+        self.frame = np.zeros((3, n), dtype=np.uint8)
+        """Most recently encoded (r, g, b) frame"""
+        self.frames = 0
+        """Number of frames encoded so far"""
+        self._previous = np.zeros_like(self.frame)
+        if dither:
+            self._fixed = np.zeros((3, n), dtype='<u2')
+            # Spread the phases, so neighbouring pixels do not flicker together
+            phase = (np.arange(3 * n) * 0.6180339887) % 1.0
+            self._error = (phase * 256).astype('<u2').reshape(3, n)
+            self._output = self._error.view(np.uint8).reshape(3, n, 2)[..., 1]
+            self._fractions = np.full((3, n), 0xff, dtype='<u2')
+        self._interleaved = np.zeros((n, 3), dtype=np.uint8)
+        self._packed = np.zeros(n, dtype=np.uint32)
+        self._changed = np.zeros((3, n), dtype=bool)
+
+    def encode(self, pixels):
+        """Clips and looks up a frame of pixel values, returns self.frame"""
+        self.frame, self._previous = self._previous, self.frame
+        # Arrays of the same dtype throughout, which avoids slow casting loops
+        clipped = self._clipped
+        np.add(pixels, self._lowest, out=clipped)
+        np.maximum(clipped, self._lowest, out=clipped)
+        np.minimum(clipped, self._highest, out=clipped)
+        # Truncate to integers, as astype(int) does
+        np.copyto(self._index, clipped, casting='unsafe')
+        if self.dither:
+            self.lut.take(self._index, out=self._fixed, mode='clip')
+            # Sigma-delta modulation: the fractions accumulate in the low byte
+            # of every pixel, and every overflow adds one to the output value
+            # in the high byte. Full values have no fraction, so never overflow.
+            self._error &= self._fractions
+            self._error += self._fixed
+            self.frame[:] = self._output
+        else:
+            self.lut.take(self._index, out=self.frame, mode='clip')
+        self.frames += 1
+        return self.frame
+
+    def changed(self):
+        """Returns the indices of the pixels that changed in the last frame
+
+        Every pixel counts as changed in the first frame.
+        """
+        if self.frames <= 1:
+            return np.arange(self.n_pixels)
+        np.not_equal(self.frame, self._previous, out=self._changed)
+        return np.flatnonzero(self._changed.any(axis=0))
+
+    def interleaved(self):
+        """Returns the encoded frame as one byte per channel, pixel by pixel"""
+        np.take(self.frame.T, self.order, axis=1, out=self._interleaved, mode='clip')
+        return self._interleaved.ravel()
+
+    def packed(self):
+        """Returns the encoded frame as one 24-bit integer per pixel
+
+        The first channel of the driver's channel order is stored in the most
+        significant byte.
+        """
+        first, second, third = self.order
+        packed = self._packed
+        packed[:] = self.frame[first]
+        packed <<= 8
+        np.bitwise_or(packed, self.frame[second], out=packed)
+        packed <<= 8
+        np.bitwise_or(packed, self.frame[third], out=packed)
+        return packed
+
+
+def for_sink(name, order='rgb', gamma=None, dither=None):
+    """Returns the encoder of an output device, configured by config.py
+
+    The brightness limit and white balance are looked up by the name of the
+    device in config.OUTPUT_BRIGHTNESS and config.WHITE_BALANCE. Gamma
+    correction and dithering default to SOFTWARE_GAMMA_CORRECTION and
+    TEMPORAL_DITHERING.
+    """
+    return PixelEncoder(
+        order=order,
+        gamma=config.SOFTWARE_GAMMA_CORRECTION if gamma is None else gamma,
+        brightness=config.OUTPUT_BRIGHTNESS.get(name, 1.0),
+        white_balance=config.WHITE_BALANCE.get(name, (1.0, 1.0, 1.0)),
+        dither=config.TEMPORAL_DITHERING if dither is None else dither)
@@ -0,0 +1,32 @@
+"""LED strips driven by ESP8266 modules over WiFi"""
+from __future__ import print_function
+from __future__ import division
+import config
+import receivers
+from sinks import Sink
+from sinks import encoding
+
+
+class ESP8266(Sink):
+    """Sends UDP packets to ESP8266 to update LED strip values
+
+    The ESP8266 will receive and decode the packets to determine what values
+    to display on the LED strip. Every receiver in config.UDP_RECEIVERS gets
+    its own part of the frame, encoded by its own adaptive codec.FrameCodec.
+    See the codec module for the packet formats.
+    """
+    def __init__(self):
+        self.encoder = encoding.for_sink('esp8266')
+        self.receivers = receivers.ReceiverGroup(config.UDP_RECEIVERS)
+
+    def update(self, pixels, features=None):
+        # The codecs send only the pixels that changed themselves
+        self.receivers.send(self.encoder.encode(pixels))
+
+    def bytes_per_frame(self):
+        """Returns the mean number of bytes sent to the ESP8266s per frame"""
+        return self.receivers.bytes_per_frame()
+
+
+def create():
+    return ESP8266()
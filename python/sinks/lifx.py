@@ -0,0 +1,191 @@
+"""LIFX smart bulbs that follow the colors of the LED strip
+
+Bulbs are found by name with a LAN broadcast, which can take seconds. The
+MAC and IP address of every bulb are therefore cached in
+config.LIFX_CACHE_PATH, so the bulbs can be used right away on the next
+start while discovery runs again in the background to pick up bulbs that
+are new or have moved to another IP address.
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import os
+import tempfile
+import threading
+import numpy as np
+import lifxlan
+import config
+import dispatch
+from sinks import Sink
+from sinks import encoding
+
+KELVIN = 3500
+"""Color temperature sent with every color"""
+
+DURATION = 25
+"""Milliseconds that a bulb takes to fade to a new color
+
+Colors of frames with an audio onset are shown at once, without fading.
+"""
+
+
+def rgb_to_hsbk(rgb, kelvin=KELVIN):
+    """Converts RGB colors to LIFX HSBK colors
+
+    Same conversion as colorsys.rgb_to_hls, for many colors at once, with
+    the lightness used as the brightness.
+
+    Parameters
+    ----------
+    rgb : np.array
+        (n, 3) array of colors between 0 and 255.
+
+    Returns
+    -------
+    hsbk : np.array
+        (n, 4) integer array of hue, saturation, brightness and kelvin.
+    """
+    rgb = np.asarray(rgb, dtype=float) / 255.0
+    r, g, b = rgb.T
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    chroma = maxc - minc
+    lightness = (maxc + minc) / 2.0
+    gray = chroma == 0.0
+    safe = np.where(gray, 1.0, chroma)
+    saturation = np.where(lightness <= 0.5,
+                          chroma / np.where(gray, 1.0, maxc + minc),
+                          chroma / np.where(gray, 1.0, 2.0 - maxc - minc))
+    rc = (maxc - r) / safe
+    gc = (maxc - g) / safe
+    bc = (maxc - b) / safe
+    hue = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    hue = (hue / 6.0) % 1.0
+    hsbk = np.empty((len(rgb), 4), dtype=int)
+    hsbk[:, 0] = np.where(gray, 0.0, hue) * 65535
+    hsbk[:, 1] = np.where(gray, 0.0, saturation) * 65535
+    hsbk[:, 2] = lightness * 65535
+    hsbk[:, 3] = kelvin
+    return hsbk
+
+
+def _load_cache(path):
+    """Returns the cached {name: {'mac': ..., 'ip': ...}} addresses"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_cache(path, cache):
+    """Writes the cache atomically, so a crash never leaves a partial file"""
+    tmp = None
+    try:
+        # A file of its own, as zone workers may save at the same time
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix='lifx_cache-',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        getattr(os, 'replace', os.rename)(tmp, path)
+    except (IOError, OSError) as e:
+        print('Failed to save the LIFX cache: {}'.format(e))
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class Bulb:
+    """A LIFX bulb showing the mean color of a segment of the LED strip"""
+    def __init__(self, name, pixels=None):
+        self.name = name
+        if pixels is None:
+            # The center of the strip
+            pixels = (config.N_PIXELS // 2, config.N_PIXELS // 2 + 1)
+        self.pixels = pixels
+        self.light = None
+        self.color = None
+
+    def connect(self, mac, ip):
+        """Uses the bulb at the given address and switches it on"""
+        light = lifxlan.Light(mac, ip)
+        light.set_power(True, rapid=True)
+        self.light = light
+        # Send the current color to the new address
+        self.color = None
+
+    def send(self, color, duration=DURATION):
+        if self.light is not None:
+            self.light.set_color(color, duration, True)
+
+
+class LIFX(Sink):
+    """Shows a segment of the LED strip on every LIFX bulb
+
+    Every bulb has its own worker thread, so the colors are sent to all
+    bulbs at once and a bulb that does not respond never delays the others.
+    """
+    def __init__(self, bulbs=None, cache_path=None):
+        self.rate = config.LIFX_FPS
+        bulbs = config.LIFX_BULBS if bulbs is None else bulbs
+        self.cache_path = config.LIFX_CACHE_PATH if cache_path is None else cache_path
+        # The bulbs apply their own gamma correction
+        self.encoder = encoding.for_sink('lifx', gamma=False, dither=False)
+        self.bulbs = [Bulb(bulb['name'], bulb.get('pixels')) for bulb in bulbs]
+        # Averages the pixels of the segment of every bulb
+        self._weights = np.zeros((len(self.bulbs), config.N_PIXELS))
+        for i, bulb in enumerate(self.bulbs):
+            start, stop = bulb.pixels
+            self._weights[i, start:stop] = 1.0 / (stop - start)
+        self._dispatcher = dispatch.Dispatcher()
+        self._workers = [self._dispatcher.add_sink('lifx ' + bulb.name,
+                                                   lambda command, bulb=bulb: bulb.send(*command))
+                         for bulb in self.bulbs]
+        self._dispatcher.start()
+        self._cache_lock = threading.Lock()
+        cache = _load_cache(self.cache_path)
+        for bulb in self.bulbs:
+            if bulb.name in cache:
+                bulb.connect(cache[bulb.name]['mac'], cache[bulb.name]['ip'])
+        self._discovery = threading.Thread(target=self.discover, name='lifx discovery')
+        self._discovery.daemon = True
+        self._discovery.start()
+
+    def discover(self):
+        """Finds every bulb on the LAN and updates the cache"""
+        lifx = lifxlan.LifxLAN()
+        for bulb in self.bulbs:
+            try:
+                light = lifx.get_device_by_name(bulb.name)
+                if light is None:
+                    raise LookupError('not found')
+                mac, ip = light.get_mac_addr(), light.get_ip_addr()
+            except Exception as e:
+                print('LIFX bulb "{}" was not discovered: {}'.format(bulb.name, e))
+                continue
+            with self._cache_lock:
+                cache = _load_cache(self.cache_path)
+                if cache.get(bulb.name) != {'mac': mac, 'ip': ip}:
+                    cache[bulb.name] = {'mac': mac, 'ip': ip}
+                    _save_cache(self.cache_path, cache)
+                    bulb.connect(mac, ip)
+                elif bulb.light is None:
+                    bulb.connect(mac, ip)
+
+    def update(self, pixels, features=None):
+        colors = rgb_to_hsbk(np.dot(self._weights, np.transpose(self.encoder.encode(pixels))))
+        duration = 0 if features is not None and features.onset else DURATION
+        for bulb, worker, color in zip(self.bulbs, self._workers, colors.tolist()):
+            # Unchanged colors are not sent again
+            if color != bulb.color:
+                bulb.color = color
+                worker.submit((color, duration))
+
+    def close(self):
+        self._dispatcher.stop()
+        for bulb in self.bulbs:
+            if bulb.light is not None:
+                bulb.light.set_power(False, rapid=True)
+
+
+def create():
+    return LIFX()
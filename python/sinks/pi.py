@@ -0,0 +1,41 @@
+"""LED strip connected directly to a Raspberry Pi"""
+from __future__ import print_function
+from __future__ import division
+import neopixel
+import config
+from sinks import Sink
+from sinks import encoding
+
+
+class Pi(Sink):
+    """Writes new LED values to the Raspberry Pi's LED strip
+
+    Raspberry Pi uses the rpi_ws281x to control the LED strip directly.
+    Only pixels that changed are written to the driver, and the strip is
+    not refreshed at all when nothing changed.
+    """
+    def __init__(self):
+        # rpi_ws281x stores every pixel as a 24-bit GRB integer
+        self.encoder = encoding.for_sink('pi', order='grb')
+        self.strip = neopixel.Adafruit_NeoPixel(config.N_PIXELS, config.LED_PIN,
+                                                config.LED_FREQ_HZ, config.LED_DMA,
+                                                config.LED_INVERT, config.BRIGHTNESS)
+        self.strip.begin()
+
+    def update(self, pixels, features=None):
+        self.encoder.encode(pixels)
+        changed = self.encoder.changed()
+        if len(changed) == 0:
+            return
+        packed = self.encoder.packed()
+        # rpi_ws281x has no bulk write: its Python binding sets one LED per
+        # ws2811_led_set() call, slices included. Writing only the changed
+        # pixels keeps the number of calls down.
+        led_data = self.strip._led_data
+        for i, value in zip(changed.tolist(), packed[changed].tolist()):
+            led_data[i] = value
+        self.strip.show()
+
+
+def create():
+    return Pi()
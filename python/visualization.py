@@ -1,12 +1,18 @@
 from __future__ import print_function
 from __future__ import division
+import threading
 import time
 import numpy as np
-from scipy.ndimage.filters import gaussian_filter1d
 import config
 import microphone
 import dsp
 import led
+import analysis
+import effects
+import pipeline
+import recording
+import metrics
+import framering
 
 _time_prev = time.time() * 1000.0
 """The previous time that the frames_per_second() function was called"""
@@ -43,336 +49,252 @@ def frames_per_second():
     return _fps.update(1000.0 / dt)
 
 
-def memoize(function):
-    """Provides a decorator for memoizing functions"""
-    from functools import wraps
-    memo = {}
-
-    @wraps(function)
-    def wrapper(*args):
-        if args in memo:
-            return memo[args]
-        else:
-            rv = function(*args)
-            memo[args] = rv
-            return rv
-    return wrapper
+prev_fps_update = time.time()
 
 
-@memoize
-def _normalized_linspace(size):
-    return np.linspace(0, 1, size)
+def capture(callback):
+    """Capture stage: timestamps every block written to the capture ring"""
+    microphone.start_stream(lambda ring: callback((metrics.clock(), ring)))
 
 
-def interpolate(y, new_length):
-    """Intelligently resizes the array by linearly interpolating the values
+def _analysis_settings():
+    """Returns the settings that the analysis is configured for"""
+    return config.MIC_RATE, config.MIN_FREQUENCY, config.MAX_FREQUENCY
 
-    Parameters
-    ----------
-    y : np.array
-        Array that should be resized
 
-    new_length : int
-        The length of the new interpolated array
+class _Analysis:
+    """Decimator, rolling window and mel filterbank for a sample rate and
+    frequency range
 
-    Returns
-    -------
-    z : np.array
-        New array with length of new_length that contains the interpolated
-        values of y.
+    The audio is decimated as far as the maximum frequency allows. The
+    rolling window, and the audio history in it, is taken over from the
+    previous analysis when the sample rate and decimation factor are the same.
     """
-    if len(y) == new_length:
-        return y
-    x_old = _normalized_linspace(len(y))
-    x_new = _normalized_linspace(new_length)
-    z = np.interp(x_new, x_old, y)
-    return z
-
-
-r_filt = dsp.ExpFilter(np.tile(0.01, config.N_PIXELS // 2),
-                       alpha_decay=0.2, alpha_rise=0.99)
-g_filt = dsp.ExpFilter(np.tile(0.01, config.N_PIXELS // 2),
-                       alpha_decay=0.05, alpha_rise=0.3)
-b_filt = dsp.ExpFilter(np.tile(0.01, config.N_PIXELS // 2),
-                       alpha_decay=0.1, alpha_rise=0.5)
-common_mode = dsp.ExpFilter(np.tile(0.01, config.N_PIXELS // 2),
-                       alpha_decay=0.99, alpha_rise=0.01)
-p_filt = dsp.ExpFilter(np.tile(1, (3, config.N_PIXELS // 2)),
-                       alpha_decay=0.1, alpha_rise=0.99)
-p = np.tile(1.0, (3, config.N_PIXELS // 2))
-gain = dsp.ExpFilter(np.tile(0.01, config.N_FFT_BINS),
-                     alpha_decay=0.001, alpha_rise=0.99)
-
-
-def visualize_scroll(y):
-    """Effect that originates in the center and scrolls outwards"""
-    global p
-    y = y**2.0
-    gain.update(y)
-    y /= gain.value
-    y *= 255.0
-    r = int(np.max(y[:len(y) // 3]))
-    g = int(np.max(y[len(y) // 3: 2 * len(y) // 3]))
-    b = int(np.max(y[2 * len(y) // 3:]))
-    # Scrolling effect window
-    p[:, 1:] = p[:, :-1]
-    p *= 0.98
-    p = gaussian_filter1d(p, sigma=0.2)
-    # Create new color originating at the center
-    p[0, 0] = r
-    p[1, 0] = g
-    p[2, 0] = b
-    # Update the LED strip
-    return np.concatenate((p[:, ::-1], p), axis=1)
-
-
-def visualize_energy(y):
-    """Effect that expands from the center with increasing sound energy"""
-    global p
-    y = np.copy(y)
-    gain.update(y)
-    y /= gain.value
-    # Scale by the width of the LED strip
-    y *= float((config.N_PIXELS // 2) - 1)
-    # Map color channels according to energy in the different freq bands
-    scale = 0.9
-    r = int(np.mean(y[:len(y) // 3]**scale))
-    g = int(np.mean(y[len(y) // 3: 2 * len(y) // 3]**scale))
-    b = int(np.mean(y[2 * len(y) // 3:]**scale))
-    # Assign color to different frequency regions
-    p[0, :r] = 255.0
-    p[0, r:] = 0.0
-    p[1, :g] = 255.0
-    p[1, g:] = 0.0
-    p[2, :b] = 255.0
-    p[2, b:] = 0.0
-    p_filt.update(p)
-    p = np.round(p_filt.value)
-    # Apply substantial blur to smooth the edges
-    p[0, :] = gaussian_filter1d(p[0, :], sigma=4.0)
-    p[1, :] = gaussian_filter1d(p[1, :], sigma=4.0)
-    p[2, :] = gaussian_filter1d(p[2, :], sigma=4.0)
-    # Set the new pixel value
-    return np.concatenate((p[:, ::-1], p), axis=1)
-
-
-_prev_spectrum = np.tile(0.01, config.N_PIXELS // 2)
-
-
-def visualize_spectrum(y):
-    """Effect that maps the Mel filterbank frequencies onto the LED strip"""
-    global _prev_spectrum
-    y = np.copy(interpolate(y, config.N_PIXELS // 2))
-    common_mode.update(y)
-    diff = y - _prev_spectrum
-    _prev_spectrum = np.copy(y)
-    # Color channel mappings
-    r = r_filt.update(y - common_mode.value)
-    g = np.abs(diff)
-    b = b_filt.update(np.copy(y))
-    # Mirror the color channels for symmetric output
-    r = np.concatenate((r[::-1], r))
-    g = np.concatenate((g[::-1], g))
-    b = np.concatenate((b[::-1], b))
-    output = np.array([r, g,b]) * 255
-    return output
-
-
-fft_plot_filter = dsp.ExpFilter(np.tile(1e-1, config.N_FFT_BINS),
-                         alpha_decay=0.5, alpha_rise=0.99)
-mel_gain = dsp.ExpFilter(np.tile(1e-1, config.N_FFT_BINS),
-                         alpha_decay=0.01, alpha_rise=0.99)
-mel_smoothing = dsp.ExpFilter(np.tile(1e-1, config.N_FFT_BINS),
-                         alpha_decay=0.5, alpha_rise=0.99)
-volume = dsp.ExpFilter(config.MIN_VOLUME_THRESHOLD,
-                       alpha_decay=0.02, alpha_rise=0.02)
-fft_window = np.hamming(int(config.MIC_RATE / config.FPS) * config.N_ROLLING_HISTORY)
-prev_fps_update = time.time()
+    def __init__(self, settings, previous=None):
+        rate, min_frequency, max_frequency = settings
+        factor = dsp.decimation_factor(rate, max_frequency)
+        self.settings = settings
+        self.layout = rate, factor
+        if previous is not None and previous.layout == self.layout:
+            self.decimator = previous.decimator
+            self.window = previous.window
+        else:
+            window_samples = int(rate / config.FPS) * config.N_ROLLING_HISTORY
+            n_channels = 2 if _stereo else None
+            self.decimator = dsp.Decimator(factor, window_samples, n_channels) if factor > 1 else None
+            self.window = dsp.AudioWindow(window_samples // factor, n_channels=n_channels)
+        self.mel_bank = dsp.build_mel_bank(rate / factor, self.window.fft_size,
+                                           min_frequency, max_frequency)
 
 
-def microphone_update(audio_samples):
-    global y_roll, prev_rms, prev_exp, prev_fps_update, _silence
-    # Normalize samples between 0 and 1
-    y = audio_samples / 2.0**15
-    # Construct a rolling window of audio samples
-    y_roll[:-1] = y_roll[1:]
-    y_roll[-1, :] = np.copy(y)
-    y_data = np.concatenate(y_roll, axis=0).astype(np.float32)
+def _reconfigure():
+    """Swaps in the analysis that was rebuilt in the background, and starts
+    rebuilding it when the settings changed
 
-    vol = np.max(np.abs(y_data))
+    Called by the analysis stage before every frame, so a frame never waits
+    for a rebuild and never sees a partly rebuilt analysis.
+    """
+    global _analysis, _rebuilt, _builder
+    if _rebuilt is not None:
+        _analysis, _rebuilt = _rebuilt, None
+    settings = _analysis_settings()
+    if settings == _analysis.settings or _rebuilt is not None or (
+            _builder is not None and _builder.is_alive()):
+        return
+    previous = _analysis
+
+    def rebuild():
+        global _rebuilt
+        _rebuilt = _Analysis(settings, previous)
+    _builder = threading.Thread(target=rebuild, name='analysis rebuild')
+    _builder.daemon = True
+    _builder.start()
+
+
+def analyze(blocks):
+    """Analysis stage: turns the latest audio samples into an LED frame
+
+    Runs once per frame deadline with every (capture time, capture ring)
+    block that arrived since the previous frame, which may be none at all.
+    Returns a (features, pixels, capture time) tuple, where features are the
+    analysis.Features of the frame. The features are None when the audio
+    volume is below the threshold and the LED strip should be switched off.
+    """
+    global _silence, _frame_index
+    # The audio device may not use the configured sample rate, and the GUI
+    # changes the frequency range
+    _reconfigure()
+    audio_window = _analysis.window
+    decimator = _analysis.decimator
+    captured = blocks[-1][0] if blocks else None
+    if metrics.enabled and blocks:
+        # How long every block waited between its capture and this frame
+        now = metrics.clock()
+        for timestamp, _ in blocks:
+            metrics.observe('led_stage_seconds', now - timestamp, stage='capture')
+    _frame_index = (_frame_index + 1) % len(_pixels)
+    pixels = _pixels[_frame_index]
+    # Normalize samples between 0 and 1 and append them to the rolling window.
+    # Only the newest samples that fit in the window are converted.
+    if blocks:
+        ring = blocks[-1][1]
+        factor = 1 if decimator is None else decimator.factor
+        samples = ring.read(audio_window.size * factor, config.AUDIO_CHANNELS, 1.0 / 2.0**15)
+        if decimator is not None:
+            with metrics.timed('decimate'):
+                samples = decimator.process(samples)
+        audio_window.push(samples)
+
+    vol = audio_window.peak()
     if vol < config.MIN_VOLUME_THRESHOLD:
         if not _silence:
           print('No audio input. Volume below threshold. Volume:', vol) # only print the warning once
           _silence = True
-        led.pixels = np.tile(0, (3, config.N_PIXELS))
-        led.update()
-    else:
-        _silence = False
-        # Transform audio input into the frequency domain
-        N = len(y_data)
-        N_zeros = 2**int(np.ceil(np.log2(N))) - N
-        # Pad with zeros until the next power of two
-        y_data *= fft_window
-        y_padded = np.pad(y_data, (0, N_zeros), mode='constant')
-        YS = np.abs(np.fft.rfft(y_padded)[:N // 2])
-        # Construct a Mel filterbank from the FFT data
-        mel = np.atleast_2d(YS).T * dsp.mel_y.T
-        # Scale data to values more suitable for visualization
-        # mel = np.sum(mel, axis=0)
-        mel = np.sum(mel, axis=0)
-        mel = mel**2.0
-        # Gain normalization
-        mel_gain.update(np.max(gaussian_filter1d(mel, sigma=1.0)))
-        mel /= mel_gain.value
-        mel = mel_smoothing.update(mel)
-        # Map filterbank output onto LED strip
-        output = visualization_effect(mel)
-        led.pixels = output
-        led.update()
-        if config.USE_GUI:
-            # Plot filterbank output
-            x = np.linspace(config.MIN_FREQUENCY, config.MAX_FREQUENCY, len(mel))
-            mel_curve.setData(x=x, y=fft_plot_filter.update(mel))
-            # Plot the color channels
-            r_curve.setData(y=led.pixels[0])
-            g_curve.setData(y=led.pixels[1])
-            b_curve.setData(y=led.pixels[2])
-    if config.USE_GUI:
-        app.processEvents()
+        pixels.fill(0.0)
+        return None, pixels, captured
+    _silence = False
+    # Transform audio input into the frequency domain
+    with metrics.timed('fft'):
+        YS = audio_window.spectrum()
+    # Construct a Mel filterbank from the FFT data
+    with metrics.timed('mel'):
+        mel = analysis.scale_mel(_analysis.mel_bank.project(YS))
+    # Every feature that the effect and the output devices use, computed once
+    with metrics.timed('features'):
+        features = _extractor.extract(mel, audio_window.samples, out=_features[_frame_index])
+    # Map the features onto LED strip
+    with metrics.timed('effect'):
+        visualization_effect(features, pixels)
+    return features, pixels, captured
+
+
+def output(frame):
+    """Output stage: displays an analysed frame on the LED strip"""
+    global prev_fps_update
+    features, pixels, captured = frame
+    led.pixels = pixels
+    led.features = features
+    led.update(captured)
+    if recorder is not None:
+        recorder.write(pixels)
+    if gui_frames is not None:
+        with metrics.timed('gui'):
+            mel = None if features is None else features.mel
+            if mel is not None and mel.ndim > 1:
+                # The GUI shows the mean of the stereo channels
+                mel = np.mean(mel, axis=0, out=_gui_mel)
+            gui_frames.write(mel, pixels)
 
     if config.DISPLAY_FPS:
         fps = frames_per_second()
         if time.time() - 0.5 > prev_fps_update:
             prev_fps_update = time.time()
-            print('FPS {:.0f} / {:.0f}'.format(fps, config.FPS))
+            depths = ', '.join('{} {} ({} dropped)'.format(*q)
+                               for q in visualization_pipeline.queue_depths())
+            print('FPS {:.0f} / {:.0f} | missed deadlines: {} | queues: {}'.format(
+                fps, config.FPS, visualization_pipeline.missed_deadlines(), depths))
+            if config.DEVICE == 'esp8266':
+                print('ESP8266 {:.0f} bytes/frame'.format(led.bytes_per_frame()))
+
+
+_stereo = config.AUDIO_CHANNELS == 'stereo'
+"""Whether the left and right channels are analysed and displayed separately"""
+
+_analysis = _Analysis(_analysis_settings())
+"""Analysis in use, replaced by _reconfigure() between frames"""
 
+_rebuilt = None
+"""Analysis for new settings, built in the background and not in use yet"""
 
-# Number of audio samples to read every time frame
-samples_per_frame = int(config.MIC_RATE / config.FPS)
+_builder = None
+"""Thread that builds _rebuilt"""
 
-# Array containing the rolling audio sample window
-y_roll = np.random.rand(config.N_ROLLING_HISTORY, samples_per_frame) / 1e16
+_pixels = np.zeros((config.PIPELINE_QUEUE_SIZE + 2, 3, config.N_PIXELS))
+"""Frames handed to the output stage, reused round-robin
 
-visualization_effect = visualize_spectrum
+Effects render in place into these buffers. There is one for every frame
+the output queue holds, the frame being displayed and the one being
+rendered, so a frame is not overwritten while it is still in use.
+"""
+
+_features = [analysis.Features(2 if _stereo else None)
+             for _ in range(config.PIPELINE_QUEUE_SIZE + 2)]
+"""Audio features of the frames in _pixels, one row per channel in stereo"""
+
+_extractor = analysis.FeatureExtractor(2 if _stereo else None)
+"""Computes the audio features of every frame"""
+
+_gui_mel = np.zeros(config.N_FFT_BINS)
+"""Mean mel energies of the stereo channels, shown by the GUI"""
+
+_frame_index = 0
+
+visualization_effect = effects.create('spectrum')
 """Visualization effect to display on the LED strip"""
 
+visualization_pipeline = pipeline.Pipeline(capture,
+                                           [('analysis', analyze, config.FPS),
+                                            ('output', output)])
+"""Capture, analysis and output stages, each running on its own thread
+
+The analysis stage renders frames at config.FPS regardless of the block
+size used by the audio driver.
+"""
+
+gui_frames = framering.FrameRing(config.N_FFT_BINS, config.N_PIXELS) if config.USE_GUI else None
+"""Shared memory ring read by the GUI process"""
+
+recorder = recording.Recorder(config.RECORD_PATH) if config.RECORD_PATH else None
+"""Records every displayed frame when config.RECORD_PATH is set"""
+
+
+def apply_control(message):
+    """Applies a ('effect', name), ('frequency', min_hz, max_hz) or
+    ('chroma_scaled',) message sent by the GUI process"""
+    global visualization_effect
+    if message[0] == 'effect':
+        visualization_effect = effects.create(message[1])
+    elif message[0] == 'frequency':
+        # The analysis stage rebuilds its filterbank in the background and
+        # swaps it in between two frames
+        config.MIN_FREQUENCY, config.MAX_FREQUENCY = message[1:]
+    elif message[0] == 'chroma_scaled':
+        config.CHROMA_VISTYPE_SCALED = not config.CHROMA_VISTYPE_SCALED
+
 
 if __name__ == '__main__':
-    if config.USE_GUI:
-        import pyqtgraph as pg
-        from pyqtgraph.Qt import QtGui, QtCore
-
-        class WutView(pg.GraphicsView):
-          """
-          This cute little view simply adds keyboard controls to the main frame.
-          Just press keys 1, 2 or 3 on your keyboard to switch between modes with the visualisation window focused
-          """
-          def keyPressEvent(self, event):
-            k = event.text()
-            if k == "1":
-              energy_click(0)
-            if k == "2":
-              scroll_click(0)
-            if k == "3":
-              spectrum_click(0)
-            if k == "4":
-              config.CHROMA_VISTYPE_SCALED = not config.CHROMA_VISTYPE_SCALED
-
-        # Create GUI window
-        app = QtGui.QApplication([])
-        view = WutView()
-        layout = pg.GraphicsLayout(border=(100,100,100))
-        view.setCentralItem(layout)
-        view.show()
-        view.setWindowTitle('Visualization')
-        view.resize(800,600)
-        # Mel filterbank plot
-        fft_plot = layout.addPlot(title='Filterbank Output', colspan=3)
-        fft_plot.setRange(yRange=[-0.1, 1.2])
-        fft_plot.disableAutoRange(axis=pg.ViewBox.YAxis)
-        x_data = np.array(range(1, config.N_FFT_BINS + 1))
-        mel_curve = pg.PlotCurveItem()
-        mel_curve.setData(x=x_data, y=x_data*0)
-        fft_plot.addItem(mel_curve)
-        # Visualization plot
-        layout.nextRow()
-        led_plot = layout.addPlot(title='Visualization Output', colspan=3)
-        led_plot.setRange(yRange=[-5, 260])
-        led_plot.disableAutoRange(axis=pg.ViewBox.YAxis)
-        # Pen for each of the color channel curves
-        r_pen = pg.mkPen((255, 30, 30, 200), width=4)
-        g_pen = pg.mkPen((30, 255, 30, 200), width=4)
-        b_pen = pg.mkPen((30, 30, 255, 200), width=4)
-        # Color channel curves
-        r_curve = pg.PlotCurveItem(pen=r_pen)
-        g_curve = pg.PlotCurveItem(pen=g_pen)
-        b_curve = pg.PlotCurveItem(pen=b_pen)
-        # Define x data
-        x_data = np.array(range(1, config.N_PIXELS + 1))
-        r_curve.setData(x=x_data, y=x_data*0)
-        g_curve.setData(x=x_data, y=x_data*0)
-        b_curve.setData(x=x_data, y=x_data*0)
-        # Add curves to plot
-        led_plot.addItem(r_curve)
-        led_plot.addItem(g_curve)
-        led_plot.addItem(b_curve)
-        # Frequency range label
-        freq_label = pg.LabelItem('')
-        # Frequency slider
-        def freq_slider_change(tick):
-            minf = freq_slider.tickValue(0)**2.0 * (config.MIC_RATE / 2.0)
-            maxf = freq_slider.tickValue(1)**2.0 * (config.MIC_RATE / 2.0)
-            t = 'Frequency range: {:.0f} - {:.0f} Hz'.format(minf, maxf)
-            freq_label.setText(t)
-            config.MIN_FREQUENCY = minf
-            config.MAX_FREQUENCY = maxf
-            dsp.create_mel_bank()
-        freq_slider = pg.TickSliderItem(orientation='bottom', allowAdd=False)
-        freq_slider.addTick((config.MIN_FREQUENCY / (config.MIC_RATE / 2.0))**0.5)
-        freq_slider.addTick((config.MAX_FREQUENCY / (config.MIC_RATE / 2.0))**0.5)
-        freq_slider.tickMoveFinished = freq_slider_change
-        freq_label.setText('Frequency range: {} - {} Hz'.format(
-            config.MIN_FREQUENCY,
-            config.MAX_FREQUENCY))
-        # Effect selection
-        active_color = '#16dbeb'
-        inactive_color = '#FFFFFF'
-        def energy_click(x):
-            global visualization_effect
-            visualization_effect = visualize_energy
-            energy_label.setText('Energy', color=active_color)
-            scroll_label.setText('Scroll', color=inactive_color)
-            spectrum_label.setText('Spectrum', color=inactive_color)
-        def scroll_click(x):
-            global visualization_effect
-            visualization_effect = visualize_scroll
-            energy_label.setText('Energy', color=inactive_color)
-            scroll_label.setText('Scroll', color=active_color)
-            spectrum_label.setText('Spectrum', color=inactive_color)
-        def spectrum_click(x):
-            global visualization_effect
-            visualization_effect = visualize_spectrum
-            energy_label.setText('Energy', color=inactive_color)
-            scroll_label.setText('Scroll', color=inactive_color)
-            spectrum_label.setText('Spectrum', color=active_color)
-        # Create effect "buttons" (labels with click event)
-        energy_label = pg.LabelItem('Energy')
-        scroll_label = pg.LabelItem('Scroll')
-        spectrum_label = pg.LabelItem('Spectrum')
-        energy_label.mousePressEvent = energy_click
-        scroll_label.mousePressEvent = scroll_click
-        spectrum_label.mousePressEvent = spectrum_click
-        energy_click(0)
-        # Layout
-        layout.nextRow()
-        layout.addItem(freq_label, colspan=3)
-        layout.nextRow()
-        layout.addItem(freq_slider, colspan=3)
-        layout.nextRow()
-        layout.addItem(energy_label)
-        layout.addItem(scroll_label)
-        layout.addItem(spectrum_label)
-    # Initialize LEDs
+    # Initialize the output devices and switch the LEDs on
+    led.start()
     led.update()
+    if metrics.enabled:
+        for name, q in visualization_pipeline.queues:
+            metrics.gauge('led_queue_depth', q.__len__, queue=name)
+            metrics.counter('led_queue_dropped_total', lambda q=q: q.dropped, queue=name)
+        metrics.counter('led_missed_deadlines_total', visualization_pipeline.missed_deadlines)
+        metrics.serve()
     # Start listening to live audio stream
-    microphone.start_stream(microphone_update)
+    visualization_pipeline.start()
+    try:
+        # The sample rate of the device is only known once its stream is open
+        while config.USE_GUI and visualization_pipeline.capturing():
+            if microphone.stream_opened.wait(0.5):
+                break
+        if config.USE_GUI and microphone.stream_opened.is_set():
+            # The GUI runs in its own process and reads frames from gui_frames
+            gui = framering.GUIProcess(gui_frames, {
+                'mic_rate': config.MIC_RATE,
+                'min_frequency': config.MIN_FREQUENCY,
+                'max_frequency': config.MAX_FREQUENCY,
+                'gui_fps': config.GUI_FPS})
+            for message in gui.messages():
+                apply_control(message)
+        # Keep the LEDs running after the GUI window has been closed
+        visualization_pipeline.join()
+    finally:
+        # Also runs when the signal handler of led.py exits. The output stage
+        # writes to gui_frames, so it has to finish before the ring is closed
+        visualization_pipeline.stop()
+        if gui_frames is not None:
+            gui_frames.close()
+        if recorder is not None:
+            recorder.close()
@@ -0,0 +1,214 @@
+"""Runs several independent visualizations, one worker process per zone
+
+Every zone in config.ZONES gets its own audio input, analysis, effect and LED
+outputs running in a separate Python process, so zones never share the GIL
+and throughput scales with the number of cores. Workers can be pinned to a
+core, are started and stopped from here and report their statistics back as
+one JSON record per line on their standard output.
+
+Workers are started as fresh interpreters rather than with multiprocessing,
+so the per-zone config overrides are applied before any of the real-time
+modules are imported.
+
+Usage:
+    python zones.py
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import config
+
+STATS_INTERVAL = 1.0
+"""Seconds between the statistics reported by every worker"""
+
+FIXED_SETTINGS = ('DEVICE', 'UDP_IP', 'UDP_IP2')
+"""Settings that a zone cannot override, like DEVICES_ENABLED['LED_STRIP2']
+
+Other settings of config.py are derived from them when it is imported, and
+would keep the values of the default device.
+"""
+
+
+class Zone:
+    """Worker process running the visualization of one zone"""
+    def __init__(self, settings):
+        self.settings = settings
+        self.name = settings['name']
+        self.process = None
+        self.stats = {}
+        self._reader = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker',
+             json.dumps(self.settings)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        self._reader = threading.Thread(target=self._read, name=self.name)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read(self):
+        for line in iter(self.process.stdout.readline, ''):
+            try:
+                stats = json.loads(line)
+            except ValueError:
+                # Anything else the worker printed
+                sys.stdout.write('[{}] {}'.format(self.name, line))
+                continue
+            previous = self.stats
+            if previous:
+                dt = stats['time'] - previous['time']
+                stats['fps'] = (stats['frames'] - previous['frames']) / dt if dt > 0.0 else 0.0
+            self.stats = stats
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, timeout=5.0):
+        """Asks the worker to exit by closing its input, then kills it"""
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        deadline = time.time() + timeout
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+class ZoneRunner:
+    """Starts, stops and monitors the worker of every zone"""
+    def __init__(self, zones=None):
+        zones = config.ZONES if zones is None else zones
+        names = [zone['name'] for zone in zones]
+        assert len(set(names)) == len(names), 'Zone names must be unique'
+        self.zones = [Zone(zone) for zone in zones]
+
+    def start(self):
+        for zone in self.zones:
+            zone.start()
+
+    def stop(self):
+        for zone in self.zones:
+            zone.stop()
+
+    def stats(self):
+        """Returns the latest statistics of every zone and their totals"""
+        zones = dict((zone.name, dict(zone.stats, running=zone.running))
+                     for zone in self.zones)
+        total = {}
+        for key in ('fps', 'frames', 'missed_deadlines', 'dropped'):
+            total[key] = sum(stats.get(key, 0) for stats in zones.values())
+        total['running'] = sum(stats['running'] for stats in zones.values())
+        return {'zones': zones, 'total': total}
+
+    def wait(self):
+        """Prints the statistics until every worker has exited"""
+        while any(zone.running for zone in self.zones):
+            time.sleep(STATS_INTERVAL)
+            stats = self.stats()
+            print(' | '.join(
+                ['{} {:.0f} FPS'.format(name, s.get('fps', 0.0))
+                 for name, s in sorted(stats['zones'].items())] +
+                ['total {fps:.0f} FPS, {missed_deadlines} missed deadlines, '
+                 '{dropped} dropped'.format(**stats['total'])]))
+
+
+def _pin(cpus):
+    """Restricts the current process to the given CPU core(s)"""
+    if isinstance(cpus, int):
+        cpus = [cpus]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    else:
+        print('CPU pinning is not supported on this platform')
+
+
+def _watch_input(stop):
+    """Sets the stop event when the runner closes our standard input"""
+    for _ in iter(sys.stdin.readline, ''):
+        pass
+    stop.set()
+
+
+def _apply_overrides(overrides):
+    """Applies the config overrides of a zone and checks the result"""
+    overrides = dict(overrides)
+    fixed = sorted(set(overrides) & set(FIXED_SETTINGS))
+    if 'DEVICES_ENABLED' in overrides:
+        enabled = overrides['DEVICES_ENABLED']
+        # The second LED strip is added to UDP_RECEIVERS by config.py too
+        if enabled.get('LED_STRIP2', config.DEVICES_ENABLED['LED_STRIP2']) \
+                != config.DEVICES_ENABLED['LED_STRIP2']:
+            fixed.append("DEVICES_ENABLED['LED_STRIP2']")
+        # Devices that the zone does not mention keep their setting
+        overrides['DEVICES_ENABLED'] = dict(config.DEVICES_ENABLED, **enabled)
+    if fixed:
+        raise ValueError('Zones cannot override {}, as config.py derives other '
+                         'settings from it. Override UDP_RECEIVERS to choose the '
+                         'ESP8266s of a zone'.format(', '.join(fixed)))
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    config.check()
+
+
+def run_worker(settings):
+    """Entry point of a worker process"""
+    _apply_overrides(settings.get('config', {}))
+    # The GUI and FPS printouts are not available in a worker
+    config.USE_GUI = False
+    config.DISPLAY_FPS = False
+    if settings.get('cpu') is not None:
+        _pin(settings['cpu'])
+    import led
+    import metrics
+    import visualization
+    visualization.visualization_effect = visualization.effects.create(
+        settings.get('effect', 'spectrum'))
+    pipeline = visualization.visualization_pipeline
+    led.update()
+    if metrics.enabled:
+        metrics.serve()
+    pipeline.start()
+    stop = threading.Event()
+    watcher = threading.Thread(target=_watch_input, args=(stop,))
+    watcher.daemon = True
+    watcher.start()
+    while not stop.wait(STATS_INTERVAL):
+        queues = pipeline.queue_depths()
+        sys.stdout.write(json.dumps({
+            'time': time.time(),
+            'pid': os.getpid(),
+            'frames': pipeline.frames(),
+            'missed_deadlines': pipeline.missed_deadlines(),
+            'dropped': sum(dropped for _, _, dropped in queues),
+            'queues': dict((name, depth) for name, depth, _ in queues)}) + '\n')
+        sys.stdout.flush()
+    pipeline.stop()
+    led.stop()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--worker':
+        run_worker(json.loads(sys.argv[2]))
+    else:
+        assert config.ZONES, 'No zones configured, see ZONES in config.py'
+        runner = ZoneRunner()
+        runner.start()
+        try:
+            runner.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            runner.stop()